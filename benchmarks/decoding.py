@@ -0,0 +1,69 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""JSON decoding benchmark
+
+Encodes a synthetic GetProfilePhotos listing and measures decoding of the
+response bytes with every installed decoder of kurek.decoders, compared to
+the previous path (bytes decoded to str, then parsed with json.loads).
+
+Usage: python benchmarks/decoding.py [--items N] [--runs N]
+"""
+
+import json
+import time
+import argparse
+
+from kurek import decoders
+
+from memory import listing
+
+
+def best_time(function, data, runs):
+    """Measure the best time of decoding data
+
+    Args:
+        function (Callable): decoding function
+        data (bytes): JSON document
+        runs (int): number of runs
+
+    Returns:
+        float: time in seconds
+    """
+
+    best = float('inf')
+    for _ in range(runs):
+        start = time.perf_counter()
+        function(data)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    """Run the benchmark
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--items', type=int, default=5000)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    data = json.dumps(listing(args.items)).encode('utf-8')
+    print(f'listing: {args.items} items, {len(data) / 2**20:.2f} MiB')
+    candidates = [('json (str)', lambda data: json.loads(data.decode()))]
+    for name in decoders.DECODERS:
+        try:
+            candidates.append((name, decoders.decoder(name)))
+        except ImportError:
+            print(f'{name:>10}: not installed')
+    baseline = None
+    for name, function in candidates:
+        elapsed = best_time(function, data, args.runs)
+        baseline = baseline or elapsed
+        print(f'{name:>10}: {elapsed * 1000:8.2f} ms '
+              f'{len(data) / 2**20 / elapsed:8.1f} MiB/s '
+              f'{baseline / elapsed:6.2f}x')
+
+
+if __name__ == '__main__':
+    main()
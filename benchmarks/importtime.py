@@ -0,0 +1,82 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""Cold start benchmark
+
+Measures import time of the CLI module with 'python -X importtime' and the
+wall time of 'kurek --help'. Also reports the import time of the full
+download stack, which is loaded only after arguments are parsed.
+
+Usage: python benchmarks/importtime.py [--runs N] [--top N]
+"""
+
+import sys
+import time
+import argparse
+import subprocess
+
+
+def import_times(module):
+    """Import a module in a fresh interpreter and collect import times
+
+    Args:
+        module (str): module name
+
+    Returns:
+        list: (cumulative us, module name) tuples, slowest first
+    """
+
+    result = subprocess.run([sys.executable, '-X', 'importtime',
+                             '-c', f'import {module}'],
+                            stderr=subprocess.PIPE,
+                            check=True,
+                            text=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times.append((int(cumulative), name.strip()))
+    return sorted(times, reverse=True)
+
+
+def help_time(runs):
+    """Measure the best wall time of 'python -m kurek --help'
+
+    Args:
+        runs (int): number of runs
+
+    Returns:
+        float: time in seconds
+    """
+
+    best = float('inf')
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-m', 'kurek', '--help'],
+                       stdout=subprocess.DEVNULL,
+                       check=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    """Run the benchmark
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    for module in ('kurek.__main__', 'kurek.downloaders'):
+        times = import_times(module)
+        print(f'import {module}: {times[0][0] / 1000:.1f} ms')
+        for cumulative, name in times[1:args.top + 1]:
+            print(f'    {cumulative / 1000:8.1f} ms  {name}')
+    print(f'kurek --help: {help_time(args.runs) * 1000:.1f} ms '
+          f'(best of {args.runs})')
+
+
+if __name__ == '__main__':
+    main()
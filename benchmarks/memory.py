@@ -0,0 +1,106 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""Memory benchmark of listing items
+
+Builds a synthetic GetProfilePhotos listing and measures memory held by
+compact item records compared to the previous layout, in which every item
+kept its listing JSON and an ItemInfo object.
+
+Usage: python benchmarks/memory.py [--items N]
+"""
+
+import gc
+import argparse
+import tracemalloc
+
+from kurek.json import ProfilePhotos
+
+
+class LegacyInfo:
+    """Attributes of the former ItemInfo object
+    """
+
+    def __init__(self, itype, data, ldata):
+        self.json = None
+        self._data = data
+        self._ldata = ldata
+        self._type = itype
+
+
+class LegacyItem:
+    """Attributes of the former Item object holding its listing JSON
+    """
+
+    def __init__(self, json):
+        self.json = json
+        self.type = 'photo'
+        self.info = LegacyInfo(self.type, json['data'], json['lData'])
+
+
+def listing(count):
+    """Create a synthetic listing JSON
+
+    Args:
+        count (int): number of items
+
+    Returns:
+        dict: GetProfilePhotos-like response
+    """
+
+    return {
+        'items': [{
+            # decoded JSON holds a separate string object for every item
+            'nick': ''.join(['profile', '']),
+            'data': f'{i:032x}',
+            'lData': f'{i * 7919:016x}',
+            'title': f'photo title {i}',
+            'description': '' if i % 3 else f'description of photo {i}',
+            'access': True,
+            'src200': f'https://photos.zbiornik.com/200/{i:032x}.jpg',
+            'src640': f'https://photos.zbiornik.com/640/{i:032x}.jpg',
+            'src1280': f'https://photos.zbiornik.com/1280/{i:032x}.jpg',
+        } for i in range(count)]
+    }
+
+
+def traced():
+    """Memory currently allocated by Python objects
+
+    Returns:
+        int: number of bytes
+    """
+
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def main():
+    """Run the benchmark
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--items', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    start = traced()
+    json = listing(args.items)
+    legacy = [LegacyItem(item) for item in json['items']]
+    before = traced() - start
+    del legacy
+
+    photos = ProfilePhotos('profile')
+    photos.parse(json)
+    del json
+    after = traced() - start
+
+    for name, size in (('before (JSON + objects)', before),
+                       ('after (records only)', after)):
+        print(f'{name:>24}: {size / 2**20:9.1f} MiB '
+              f'{size / args.items:7.1f} B/item')
+    print(f'{"saved":>24}: {1 - after / before:9.1%}')
+
+
+if __name__ == '__main__':
+    main()
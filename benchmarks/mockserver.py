@@ -0,0 +1,251 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""Local stand-in for zbiornik.com
+
+Serves the main page with a login token, the AJAX commands built by
+kurek.ajax.Command and synthetic media with HTTP Range support. Response
+latency, error rate and media sizes are configurable. Every profile name is
+valid and has the same number of photos and videos.
+
+Point kurek at the server with config.scheme, config.port and
+config.addresses (see configure).
+
+Usage: python benchmarks/mockserver.py [--port N] [--photos N] [--videos N]
+    [--photo-size B] [--video-size B] [--latency S] [--error-rate P]
+    [--shared N]
+"""
+
+import re
+import random
+import asyncio
+import argparse
+
+from aiohttp import web
+
+from kurek import config
+
+
+_range = re.compile(r'bytes=(\d+)-(\d*)')
+
+
+def configure(port, address='127.0.0.1'):
+    """Direct site and API hosts of kurek to a local server
+
+    Args:
+        port (int): server port
+        address (str, optional): server address. Defaults to '127.0.0.1'.
+    """
+
+    config.scheme = 'http'
+    config.port = port
+    hosts = [config.host] + [f'{server}.{config.host}'
+                             for server in config.api_servers]
+    config.addresses = dict.fromkeys(hosts, address)
+
+
+class MockSite:
+    """aiohttp application imitating the site
+    """
+
+    def __init__(self,
+                 photos=20,
+                 videos=5,
+                 photo_size=200 * 1024,
+                 video_size=8 * 1024 * 1024,
+                 latency=0.0,
+                 error_rate=0.0,
+                 shared=0):
+        """Create a new site
+
+        Args:
+            photos (int, optional): photos per profile. Defaults to 20.
+            videos (int, optional): videos per profile. Defaults to 5.
+            photo_size (int, optional): photo size in bytes.
+                Defaults to 200 KiB.
+            video_size (int, optional): video size in bytes.
+                Defaults to 8 MiB.
+            latency (float, optional): delay of every response in seconds.
+                Defaults to 0.
+            error_rate (float, optional): probability of a 503 response.
+                Defaults to 0.
+            shared (int, optional): number of items of every listing with
+                the same media in all profiles. Defaults to 0.
+        """
+
+        self._photos = photos
+        self._videos = videos
+        self._sizes = {'jpg': photo_size, 'mp4': video_size}
+        self._latency = latency
+        self._error_rate = error_rate
+        self._shared = shared
+        self._data = bytes(range(256)) * (max(photo_size, video_size) // 256
+                                          + 1)
+        self.requests = {}
+        self.app = web.Application()
+        self.app.router.add_get('/', self._index)
+        self.app.router.add_get(config.api_root, self._ajax)
+        self.app.router.add_get('/media/{name}', self._media)
+
+    async def _delay(self, kind):
+        self.requests[kind] = self.requests.get(kind, 0) + 1
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        if self._error_rate and random.random() < self._error_rate:
+            raise web.HTTPServiceUnavailable()
+
+    async def _index(self, _):
+        await self._delay('index')
+        return web.Response(
+            text='<html><body><form><input type="hidden" '
+                 'id="zbiornik-ltoken" value="mock-ltoken"></form>'
+                 '</body></html>',
+            content_type='text/html')
+
+    def _item(self, request, nick, kind, index, sources):
+        name = f'{nick}-{kind}{index}'
+        media = f'shared-{kind}{index}' if index < self._shared else name
+        item = {
+            'nick': nick,
+            'data': f'{media}-data',
+            'lData': f'{name}-ldata',
+            'title': f'{kind} {index}',
+            'description': '',
+            'access': True,
+        }
+        if sources:
+            base = f'{request.scheme}://{request.host}/media/{media}'
+            item.update({'src200': f'{base}-200.jpg',
+                         'src1024': f'{base}.jpg'})
+        return item
+
+    async def _ajax(self, request):
+        query = request.query
+        command = query.get('command', '')
+        await self._delay(command)
+        nick = query.get('nick', '')
+        logged = {'nick': 'mock'}
+        if command == 'login':
+            json = {'token': 'mock-token', 'loggedUser': logged}
+        elif command == 'getProfile':
+            json = {'profile': {'nick': nick}, 'loggedUser': logged}
+        elif command == 'getProfilePhotos':
+            json = {'items': [self._item(request, nick, 'photo', i, True)
+                              for i in range(self._photos)]}
+        elif command == 'getProfileVideos':
+            json = {'items': [self._item(request, nick, 'video', i, False)
+                              for i in range(self._videos)]}
+        elif command == 'getItemInfo':
+            name = query['data'][:-len('-data')]
+            base = f'{request.scheme}://{request.host}/media/{name}'
+            json = {'item': {'mp4': f'{base}.mp4',
+                             'mp4480': f'{base}-480.mp4'}}
+        else:
+            json = {'error': f'unknown command {command}'}
+        return web.json_response(json)
+
+    async def _media(self, request):
+        await self._delay('media')
+        size = self._sizes.get(request.match_info['name'][-3:], 0)
+        first, last = 0, size - 1
+        match = _range.fullmatch(request.headers.get('Range', ''))
+        if match:
+            first = int(match.group(1))
+            if match.group(2):
+                last = min(int(match.group(2)), size - 1)
+            if first >= size:
+                raise web.HTTPRequestRangeNotSatisfiable(
+                    headers={'Content-Range': f'bytes */{size}'})
+        body = memoryview(self._data)[first:last + 1]
+        response = web.Response(body=body,
+                                content_type='application/octet-stream')
+        response.headers['Accept-Ranges'] = 'bytes'
+        if match:
+            response.set_status(206)
+            response.headers['Content-Range'] = \
+                f'bytes {first}-{last}/{size}'
+        return response
+
+
+async def start(site, port=0, address='127.0.0.1'):
+    """Start serving a site
+
+    Args:
+        site (MockSite): site to serve
+        port (int, optional): port, 0 picks a free one. Defaults to 0.
+        address (str, optional): listening address.
+            Defaults to '127.0.0.1'.
+
+    Returns:
+        tuple: aiohttp AppRunner (call 'cleanup' to stop) and the port
+    """
+
+    runner = web.AppRunner(site.app, access_log=None)
+    await runner.setup()
+    server = web.TCPSite(runner, address, port)
+    await server.start()
+    port = runner.addresses[0][1]
+    return runner, port
+
+
+def parse_args(argv=None):
+    """Parse command line arguments
+
+    Args:
+        argv (list, optional): arguments. Defaults to sys.argv[1:].
+
+    Returns:
+        argparse.Namespace: parsed arguments
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--photos', type=int, default=20)
+    parser.add_argument('--videos', type=int, default=5)
+    parser.add_argument('--photo-size', type=int, default=200 * 1024)
+    parser.add_argument('--video-size', type=int, default=8 * 1024 * 1024)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--shared', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def site_from_args(args):
+    """Create a site configured with parsed arguments
+
+    Args:
+        args (argparse.Namespace): arguments from parse_args
+
+    Returns:
+        MockSite: configured site
+    """
+
+    return MockSite(args.photos,
+                    args.videos,
+                    args.photo_size,
+                    args.video_size,
+                    args.latency,
+                    args.error_rate,
+                    args.shared)
+
+
+async def serve(args):
+    """Serve until cancelled
+
+    Args:
+        args (argparse.Namespace): arguments from parse_args
+    """
+
+    runner, port = await start(site_from_args(args), args.port)
+    print(f'Serving on http://127.0.0.1:{port}', flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(serve(parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,108 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""File writing benchmark
+
+Simulates many concurrent downloads delivering data in small network-sized
+chunks and compares writing every chunk with aiofiles (one thread pool round
+trip per chunk) with FileSink (one per buffer). Reports wall time and CPU
+time (all threads) per GB written.
+
+Usage: python benchmarks/sink.py [--downloads N] [--size MB] [--chunk B]
+Requires aiofiles.
+"""
+
+import os
+import time
+import asyncio
+import argparse
+import tempfile
+
+import aiofiles
+
+from kurek.files import FileSink
+
+
+async def write_aiofiles(path, chunks, chunk):
+    """Write chunks with aiofiles like the previous download path
+
+    Args:
+        path (str): file path
+        chunks (int): number of chunks
+        chunk (bytes): chunk data
+    """
+
+    async with aiofiles.open(path, 'wb') as file:
+        for _ in range(chunks):
+            await file.write(chunk)
+            await asyncio.sleep(0)
+
+
+async def write_sink(path, chunks, chunk):
+    """Write chunks with FileSink
+
+    Args:
+        path (str): file path
+        chunks (int): number of chunks
+        chunk (bytes): chunk data
+    """
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        async with FileSink(fd) as sink:
+            for _ in range(chunks):
+                await sink.write(chunk)
+                await asyncio.sleep(0)
+    finally:
+        os.close(fd)
+
+
+async def run(writer, directory, downloads, chunks, chunk):
+    """Run concurrent writers
+
+    Args:
+        writer (Callable): coroutine function writing a single file
+        directory (str): directory for the files
+        downloads (int): number of concurrent files
+        chunks (int): number of chunks per file
+        chunk (bytes): chunk data
+
+    Returns:
+        tuple: wall time and CPU time in seconds
+    """
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    await asyncio.gather(*(writer(os.path.join(directory, f'{i}.bin'),
+                                  chunks,
+                                  chunk)
+                           for i in range(downloads)))
+    return time.perf_counter() - wall, time.process_time() - cpu
+
+
+def main():
+    """Run the benchmark
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--downloads', type=int, default=50)
+    parser.add_argument('--size', type=int, default=20, help='MB per file')
+    parser.add_argument('--chunk', type=int, default=16 * 1024)
+    args = parser.parse_args()
+
+    chunk = os.urandom(args.chunk)
+    chunks = args.size * 2**20 // args.chunk
+    gigabytes = args.downloads * chunks * args.chunk / 2**30
+    with tempfile.TemporaryDirectory() as directory:
+        for name, writer in (('aiofiles', write_aiofiles),
+                             ('FileSink', write_sink)):
+            wall, cpu = asyncio.run(run(writer,
+                                        directory,
+                                        args.downloads,
+                                        chunks,
+                                        chunk))
+            print(f'{name:>9}: {wall:6.2f}s wall, {cpu / gigabytes:6.2f}s '
+                  f'CPU per GB, {gigabytes / wall:6.2f} GB/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""End-to-end throughput benchmark
+
+Starts the mock site (benchmarks/mockserver.py) in a separate process, logs
+in and downloads a number of profiles with Session and ProfileDownloader
+into a temporary directory. Reports items/s, MB/s, API calls per item and
+peak RSS of the downloading process.
+
+Usage: python benchmarks/throughput.py [--profiles N] [--runs N]
+    [--api-limit N] [--download-limit N] [--segments N] [mock site options]
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+import contextlib
+import subprocess
+
+from kurek import config
+from kurek import metrics
+from kurek.http import Session
+from kurek.downloaders import ProfileDownloader
+
+import mockserver
+
+
+def spawn_server(argv):
+    """Start the mock site in a subprocess
+
+    Args:
+        argv (list): mock site arguments
+
+    Returns:
+        tuple: process and the port it listens on
+    """
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'mockserver.py')
+    process = subprocess.Popen([sys.executable, script, '--port', '0', *argv],
+                               stdout=subprocess.PIPE,
+                               text=True)
+    line = process.stdout.readline()
+    if not line.startswith('Serving on'):
+        process.kill()
+        raise RuntimeError('mock site did not start')
+    return process, int(line.rsplit(':', 1)[1])
+
+
+async def download(args, directory):
+    """Download all profiles from the mock site
+
+    Args:
+        args (argparse.Namespace): benchmark arguments
+        directory (str): output directory
+
+    Returns:
+        float: wall time of the download in seconds
+    """
+
+    config.root_dir = directory
+    session = Session(args.api_limit,
+                      args.download_limit,
+                      config.request_headers)
+    await session.start()
+    await session.login('mock@example.com', 'mock')
+    nicks = (f'profile{i}' for i in range(args.profiles))
+    started = time.perf_counter()
+    await ProfileDownloader(nicks).download(session)
+    elapsed = time.perf_counter() - started
+    await session.close()
+    return elapsed
+
+
+def api_calls():
+    """Count API requests recorded by the balancer
+
+    Returns:
+        int: number of API requests
+    """
+
+    snapshot = metrics.registry.snapshot()
+    return sum(entry['value']
+               for entry in snapshot['counters'].get('api_requests_total', ()))
+
+
+def main():
+    """Run the benchmark
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--profiles', type=int, default=20)
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--api-limit', type=int,
+                        default=config.max_api_requests)
+    parser.add_argument('--download-limit', type=int,
+                        default=config.max_downloads)
+    parser.add_argument('--segments', type=int, default=config.segments)
+    args, server_argv = parser.parse_known_args()
+    mockserver.parse_args(server_argv)
+
+    config.download_workers = args.download_limit
+    config.segments = args.segments
+    config.segment_threshold = 1024 * 1024
+    process, port = spawn_server(server_argv)
+    mockserver.configure(port)
+    try:
+        for run in range(args.runs):
+            metrics.registry = metrics.Metrics()
+            # progress lines of every item are not part of the report
+            with tempfile.TemporaryDirectory() as directory, \
+                    open(os.devnull, 'w', encoding='utf-8') as null, \
+                    contextlib.redirect_stdout(null):
+                elapsed = asyncio.run(download(args, directory))
+            items = metrics.registry.counter('items_total',
+                                             type='photo',
+                                             outcome='ok') + \
+                metrics.registry.counter('items_total',
+                                         type='video',
+                                         outcome='ok')
+            size = metrics.registry.counter('download_bytes_total')
+            calls = api_calls()
+            print(f'run {run + 1}: {items} items in {elapsed:.2f}s - '
+                  f'{items / elapsed:.1f} items/s, '
+                  f'{size / 2**20 / elapsed:.1f} MB/s, '
+                  f'{calls / max(items, 1):.2f} API calls/item')
+    finally:
+        process.terminate()
+        process.wait()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak *= 1024
+    print(f'peak RSS: {peak / 2**20:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,16 +6,59 @@
 Parse command line arguments and prepare the operation.
 """
 
-import asyncio
+import os
+import sys
 import argparse
+import itertools
 
 from kurek import config
-from kurek.http import Session
-from kurek.downloaders import ProfileDownloader
+from kurek import templates
 
 
-async def main():
-    """Main coroutine
+def _read_lines(path):
+    if path == '-':
+        yield from sys.stdin
+        return
+    with open(path, 'r', encoding='utf-8') as file:
+        yield from file
+
+
+def read_nicks(profiles, path=None):
+    """Stream unique profile names
+
+    Names are read lazily, so huge lists are never held in memory. Blank
+    lines and case-insensitive duplicates are skipped.
+
+    Args:
+        profiles (Iterable): profile names given as arguments
+        path (str, optional): file with profile names ('-' for stdin).
+            Defaults to None.
+
+    Yields:
+        str: profile name
+    """
+
+    seen = set()
+    lines = itertools.chain(profiles, _read_lines(path) if path else ())
+    for line in lines:
+        nick = line.strip()
+        key = nick.casefold()
+        if nick and key not in seen:
+            seen.add(key)
+            yield nick
+
+
+def parse_args(argv=None):
+    """Parse command line arguments and apply them to config
+
+    Only lightweight modules are imported up to this point, so '--help' and
+    argument errors return quickly.
+
+    Args:
+        argv (list, optional): arguments. Defaults to sys.argv[1:].
+
+    Returns:
+        argparse.Namespace: parsed arguments
     """
 
     parser = argparse.ArgumentParser(
@@ -47,20 +90,19 @@ Use responsibly! Use download and API limits. Live and let live.
                         '--email',
                         type=str,
                         metavar='EMAIL',
-                        required=True,
                         help='login email')
     parser.add_argument('-p',
                         '--pass',
                         dest='password',
                         type=str,
                         metavar='PASSWORD',
-                        required=True,
                         help='login password')
     parser.add_argument('-f',
                         '--file',
                         type=str,
                         metavar='FILE',
-                        help='file with a list of profile names (1 name/line)')
+                        help="""file with a list of profile names
+(1 name/line), '-' reads names from standard input""")
     exclude_media = parser.add_mutually_exclusive_group()
     exclude_media.add_argument('-g',
                                '--gallery',
@@ -99,9 +141,38 @@ Use responsibly! Use download and API limits. Live and let live.
     %%e - file extension
     %%o - owner's profile name
     %%d - description
+    %%%% - literal '%%'
 
-    Empty strings are replaced with '_'.
+    Empty strings are replaced with '_', path separators
+    in values are replaced with '_'.
 """)
+    parser.add_argument('--session-file',
+                        type=str,
+                        default=config.session_file,
+                        metavar='FILE',
+                        help='file to save the login session to')
+    parser.add_argument('--no-session',
+                        action='store_true',
+                        help='always log in, do not use a saved session')
+    parser.add_argument('-m',
+                        '--manifest',
+                        type=str,
+                        default=config.manifest_path,
+                        metavar='FILE',
+                        help="""database of downloaded items - items recorded
+in it are skipped without any API requests""")
+    parser.add_argument('-s',
+                        '--sync',
+                        action='store_true',
+                        help="""incremental mode - skip profiles whose listings
+did not change since the last run (uses the manifest,
+defaults to ROOT_DIR/""" + config.manifest_name + ')')
+    parser.add_argument('--dedup',
+                        action='store_true',
+                        default=config.dedup,
+                        help="""reuse media shared between profiles - known
+files are hard linked instead of downloaded (uses the
+manifest, defaults to ROOT_DIR/""" + config.manifest_name + ')')
     parser.add_argument('-a',
                         '--api-limit',
                         type=int,
@@ -114,25 +185,152 @@ Use responsibly! Use download and API limits. Live and let live.
                         default=config.max_downloads,
                         metavar='INT',
                         help='simultaneous downloads limit')
+    parser.add_argument('--api-rate',
+                        type=float,
+                        default=config.api_rate,
+                        metavar='FLOAT',
+                        help='API requests per second limit (0 - no limit)')
+    parser.add_argument('--host-rate',
+                        type=float,
+                        default=config.host_rate,
+                        metavar='FLOAT',
+                        help='requests per second limit for a single host')
+    parser.add_argument('-b',
+                        '--bandwidth',
+                        type=int,
+                        default=config.download_rate,
+                        metavar='BYTES',
+                        help='total download bandwidth limit in bytes/s')
+    parser.add_argument('-k',
+                        '--profile-limit',
+                        type=int,
+                        default=config.profile_workers,
+                        metavar='INT',
+                        help='simultaneously processed profiles limit')
+    parser.add_argument('-S',
+                        '--segments',
+                        type=int,
+                        default=config.segments,
+                        metavar='INT',
+                        help="""download large videos in INT parallel byte
+ranges - each range counts against the download limit""")
+    parser.add_argument('--fsync',
+                        choices=('never', 'close', 'always'),
+                        default=config.fsync,
+                        help="""flush saved data to disk: never, when a file
+is closed or after every written buffer""")
+    plan = parser.add_mutually_exclusive_group()
+    plan.add_argument('--plan-only',
+                      dest='plan_path',
+                      type=str,
+                      metavar='FILE',
+                      help="""resolve items and write their URLs and paths
+to a JSON Lines plan instead of downloading them""")
+    plan.add_argument('--from-plan',
+                      dest='from_plan',
+                      type=str,
+                      metavar='FILE',
+                      help="""download items of a plan ('-' reads it from
+standard input) - no login or API requests needed""")
+    parser.add_argument('-q',
+                        '--queue',
+                        type=str,
+                        default=config.queue_path,
+                        metavar='FILE',
+                        help="""shared job queue database - given profile
+names are added to it, then profiles are claimed from
+it until none are left; run on several hosts with the
+same FILE on shared storage to split the work (the
+manifest then uses a rollback journal instead of WAL,
+which does not work on network file systems)""")
+    parser.add_argument('-w',
+                        '--workers',
+                        type=int,
+                        default=config.workers,
+                        metavar='INT',
+                        help="""split profiles between INT processes - limits
+are divided evenly between them, so INT cannot exceed
+the API requests, downloads and profiles limits""")
+    parser.add_argument('--metrics',
+                        type=str,
+                        default=config.metrics_path,
+                        metavar='FILE',
+                        help='periodically write run metrics to FILE')
+    parser.add_argument('--metrics-format',
+                        choices=('json', 'prometheus'),
+                        default=config.metrics_format,
+                        help="""metrics file format: JSON snapshot or
+Prometheus textfile collector""")
+    parser.add_argument('--metrics-interval',
+                        type=float,
+                        default=config.metrics_interval,
+                        metavar='SECONDS',
+                        help='seconds between metrics file updates')
+    parser.add_argument('--profile',
+                        dest='profile_path',
+                        type=str,
+                        default=config.profile_path,
+                        metavar='PREFIX',
+                        help="""profile the run - writes cProfile statistics
+to PREFIX.pstats and timing spans to PREFIX.trace.json
+(Chrome trace format)""")
     parser.add_argument('profiles',
                         nargs='*',
                         type=str,
                         metavar='PROFILE',
                         help='list of profile names')
 
-    args = parser.parse_args()
-    if not args.profiles and not args.file:
-        parser.error('no profile names given')
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error('number of workers must be positive')
+    if args.profile_limit < 1:
+        parser.error('profile limit must be positive')
+    if args.api_limit < 1:
+        parser.error('API requests limit must be positive')
+    if args.download_limit < 1:
+        parser.error('downloads limit must be positive')
+    # every worker needs at least one request of each limit
+    for name, limit in (('API requests', args.api_limit),
+                        ('downloads', args.download_limit),
+                        ('profiles', args.profile_limit)):
+        if args.workers > limit:
+            parser.error(f'{args.workers} workers exceed the limit of '
+                         f'{limit} {name}')
+    if args.from_plan:
+        if args.profiles or args.file or args.queue:
+            parser.error('profile names cannot be used with --from-plan')
+    else:
+        if not args.profiles and not args.file and not args.queue:
+            parser.error('no profile names given')
+        if not args.email or not args.password:
+            parser.error('login email and password are required')
+    if args.file and args.file != '-':
+        # names are read lazily - check the file before logging in
+        try:
+            with open(args.file, 'r', encoding='utf-8') as file:
+                if not file.read(1):
+                    parser.error(f'file {args.file} is empty')
+        except OSError as exc:
+            parser.error(f'cannot read file {args.file}: {exc.strerror}')
+
+    try:
+        configure(args)
+    except ValueError as exc:
+        parser.error(str(exc))
+    if (args.sync or args.dedup) and not args.manifest:
+        args.manifest = os.path.join(config.root_dir, config.manifest_name)
+    return args
+
 
-    # consolidate profile names
-    file_nicks = []
-    if args.file:
-        with open(args.file, 'r', encoding='utf-8') as file:
-            file_nicks = file.read().splitlines()
-            if not file_nicks:
-                parser.error(f'file {args.file} is empty')
-    nicks = sorted([*args.profiles, *file_nicks],
-                   key=lambda s: s.lower())
+def configure(args):
+    """Apply parsed arguments to config
+
+    Args:
+        args (argparse.Namespace): parsed command line arguments
+
+    Raises:
+        ValueError: invalid path or name template
+    """
 
     # TODO: handle this better
     if args.root_dir:
@@ -141,26 +339,201 @@ Use responsibly! Use download and API limits. Live and let live.
         config.path_template = args.path_template
     if args.name_template:
         config.name_template = args.name_template
+    templates.name_template()
+    templates.path_template()
+    config.segments = args.segments
+    config.fsync = args.fsync
+    config.profile_workers = args.profile_limit
+    config.download_workers = args.download_limit
+    config.api_rate = args.api_rate
+    config.host_rate = args.host_rate
+    config.download_rate = args.bandwidth
+    if args.queue:
+        config.manifest_journal = 'DELETE'
 
-    photos = not args.only_videos
-    videos = not args.only_photos
 
-    email, password = args.email, args.password
+async def login(session, args):
+    """Log the user in, reusing the saved session unless disabled
+
+    Args:
+        session (kurek.http.Session): started session
+        args (argparse.Namespace): parsed command line arguments
+    """
+
+    from kurek.http import SessionStore, NETWORK_ERRORS
+    from kurek.retry import describe
+
+    store = None
+    if not args.no_session:
+        store = SessionStore(args.session_file, config.session_ttl)
+    try:
+        await session.login(args.email, args.password, store)
+    except NETWORK_ERRORS as exc:
+        # the traceback would show the login URL with the password
+        sys.exit(f'Login failed: {describe(exc)}')
+
+
+async def save_session(args):
+    """Log in once so that worker processes reuse the saved session
+
+    Args:
+        args (argparse.Namespace): parsed command line arguments
+    """
+
+    from kurek.http import Session
+
+    session = Session(args.api_limit, args.download_limit,
+                      config.request_headers)
+    await session.start(warm_up=False)
+    try:
+        await login(session, args)
+    finally:
+        await session.close()
+
+
+async def main(args):
+    """Main coroutine
+
+    Args:
+        args (argparse.Namespace): parsed command line arguments
+    """
+
+    # heavy dependencies are imported only once arguments are valid
+    from kurek.http import Session
+    from kurek.manifest import Manifest
+    from kurek.metrics import Exporter
+    from kurek.dedup import DedupIndex
+
+    manifest = Manifest(args.manifest) if args.manifest else None
+    dedup = DedupIndex(manifest) if args.dedup else None
+    exporter = None
+    if args.metrics:
+        exporter = Exporter(args.metrics,
+                            args.metrics_format,
+                            args.metrics_interval)
+        exporter.start()
 
     session = Session(args.api_limit,
                       args.download_limit,
                       config.request_headers)
+    try:
+        await download(session, args, manifest, dedup)
+    finally:
+        await session.close()
+        if exporter:
+            await exporter.stop()
+        if manifest:
+            # pending writes are committed
+            manifest.close()
+
+
+async def download(session, args, manifest=None, dedup=None):
+    """Download profiles or a plan
+
+    Args:
+        session (kurek.http.Session): session to start
+        args (argparse.Namespace): parsed command line arguments
+        manifest (Manifest, optional): completed downloads database.
+            Defaults to None.
+        dedup (DedupIndex, optional): reuse files with the same media.
+            Defaults to None.
+    """
+
+    from kurek.downloaders import ProfileDownloader, PlanDownloader
+    from kurek.plan import PlanWriter, read_plan
+    from kurek.jobs import JobQueue
+
+    photos = not args.only_videos
+    videos = not args.only_photos
+    if args.from_plan:
+        await session.start(warm_up=False)
+        items = (item for item in read_plan(args.from_plan)
+                 if item.type == 'photo' and photos
+                 or item.type == 'video' and videos)
+        await PlanDownloader(items, manifest, dedup).download(session)
+        return
     await session.start()
-    await session.login(email, password)
-    await ProfileDownloader(nicks).download(session, photos, videos)
-    await session.close()
+    await login(session, args)
+    plan = PlanWriter(args.plan_path) if args.plan_path else None
+    jobs = JobQueue(args.queue) if args.queue else None
+    downloader = ProfileDownloader(read_nicks(args.profiles, args.file),
+                                   manifest,
+                                   args.sync,
+                                   plan,
+                                   jobs,
+                                   dedup)
+    try:
+        await downloader.download(session, photos, videos)
+    finally:
+        if plan:
+            plan.close()
+            print(f'Planned {plan.count} items in {args.plan_path}.')
+        if jobs:
+            jobs.close()
+
+
+def enqueue(args):
+    """Add profile names given as arguments to the job queue
+
+    Args:
+        args (argparse.Namespace): parsed command line arguments - names
+            are removed from them
+    """
+
+    from kurek.jobs import JobQueue
+
+    jobs = JobQueue(args.queue)
+    try:
+        added = jobs.add(read_nicks(args.profiles, args.file))
+        counts = jobs.counts()
+    finally:
+        jobs.close()
+    print(f'Added {added} profiles to {args.queue}. Queue: ' +
+          ', '.join(f'{count} {state}'
+                    for state, count in sorted(counts.items())))
+    args.profiles, args.file = [], None
+
+
+def work(args):
+    """Run the download in this process
+
+    Entry point of worker processes as well, which have to apply their
+    arguments to config themselves.
+
+    Args:
+        args (argparse.Namespace): parsed command line arguments
+    """
+
+    configure(args)
+    if args.profile_path:
+        from kurek import profiling
+        profiling.run(main(args), args.profile_path)
+        return
+    import asyncio
+    asyncio.run(main(args))
 
 
 def run():
     """Main entry point
     """
 
-    asyncio.run(main())
+    args = parse_args()
+    if args.queue and (args.profiles or args.file):
+        enqueue(args)
+    if args.workers == 1:
+        work(args)
+        return
+    from kurek import shards
+    if args.from_plan:
+        inputs = _read_lines(args.from_plan)
+    else:
+        if not args.no_session:
+            import asyncio
+            asyncio.run(save_session(args))
+        inputs = read_nicks(args.profiles, args.file)
+    failed = shards.run(args, inputs)
+    if failed:
+        sys.exit(f'{failed} of {args.workers} workers failed.')
 
 
 if __name__ == '__main__':
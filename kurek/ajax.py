@@ -4,53 +4,192 @@
 """Classes for interacting with AJAX endpoints
 
 Used to produce commands and urls that let the user contact the API
-servers. Includes a Balancer class for limiting requests to a single server.
+servers. Includes a Balancer class for spreading requests between servers
+based on their health.
 """
 
 from yarl import URL
 
 from kurek import config
+from kurek import metrics
+from kurek.retry import CircuitBreaker
+
+
+class ServerStats:
+    """Rolling health statistics of a single API server
+    """
+
+    def __init__(self, url):
+        """Create empty statistics
+
+        Args:
+            url (yarl.URL): server base URL
+        """
+
+        self.url = url
+        self.outstanding = 0
+        self.latency = None
+        self.errors = 0.0
+        self.breaker = CircuitBreaker(config.breaker_failures,
+                                      config.breaker_cooldown)
+
+    @property
+    def available(self):
+        """Server may receive requests
+
+        A server with an open circuit breaker is unavailable until the
+        cooldown passes and then takes a single probe request at a time.
+
+        Returns:
+            bool: requests can be sent to the server
+        """
+
+        if self.breaker.closed:
+            return True
+        return self.breaker.allow() and self.outstanding == 0
+
+    def score(self, default):
+        """Expected cost of sending the next request - lower is better
+
+        Args:
+            default (float): latency assumed if none was measured yet
+                (failed requests do not measure it)
+
+        Returns:
+            float: score based on EWMA latency, load and error rate
+        """
+
+        latency = default if self.latency is None else self.latency
+        return latency * (self.outstanding + 1) / max(1.0 - self.errors, 0.01)
+
+    def record(self, latency, error):
+        """Update statistics with the outcome of a request
+
+        Args:
+            latency (float): response time in seconds or None if unknown
+            error (bool): request failed
+        """
+
+        decay = config.balancer_decay
+        self.errors += decay * (float(error) - self.errors)
+        if error:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += decay * (latency - self.latency)
 
 
 class Balancer:
     """Generate new base URL for API requests
 
-    There is a number of API servers to choose from. This class takes care of
-    remembering how many requests went to the last used server and switches
-    to the next after producing a given number of requests.
+    There is a number of API servers to choose from. This class keeps track
+    of each server's latency, error rate and requests in progress, and picks
+    the server with the lowest expected cost. Servers with the configured
+    number of requests in progress are only used when all of them are busy.
+    Servers with an open circuit breaker are skipped - if all of them are
+    failing, the one that reopens first is used.
     """
 
     def __init__(self):
-        self._urls = None
-        self._api_urls = tuple(
-            (URL.build(scheme=config.scheme,
-                       host=f'{server}.{config.host}{config.api_root}')
-             for server in config.api_servers
-             ))
-        self._urls = self._get_url_generator()
-
-    def _get_url_generator(self):
-        if self._urls:
-            return self._urls
-        return self.url_generator()
+        self._servers = tuple(
+            ServerStats(URL.build(scheme=config.scheme,
+                                  host=f'{server}.{config.host}',
+                                  port=config.port,
+                                  path=config.api_root))
+            for server in config.api_servers
+        )
+        self._hosts = {stats.url.host: stats for stats in self._servers}
+        for stats in self._servers:
+            metrics.registry.gauge('api_outstanding',
+                                   lambda stats=stats: stats.outstanding,
+                                   server=stats.url.host)
+        self._turn = 0
 
-    def url_generator(self):
-        """Counts requests made and yields next AJAX server URL
+    @property
+    def urls(self):
+        """Base URLs of all API servers
 
-        Yields:
-            yarl.URL: server URL
+        Returns:
+            tuple: server URLs
         """
 
-        while True:
-            for url in self._api_urls:
-                for _ in range(0, config.max_server_requests):
-                    yield url
+        return tuple(str(stats.url) for stats in self._servers)
+
+    def _choose(self):
+        # rotate the starting point so ties are spread across servers
+        count = len(self._servers)
+        order = [self._servers[(self._turn + i) % count]
+                 for i in range(count)]
+        self._turn = (self._turn + 1) % count
+        available = [stats for stats in order if stats.available]
+        if not available:
+            return min(order, key=lambda stats: stats.breaker.retry_at)
+        idle = [stats for stats in available
+                if stats.outstanding < config.max_server_requests]
+        # servers without measurements are not assumed to be fast
+        measured = [stats.latency for stats in self._servers
+                    if stats.latency is not None]
+        default = sum(measured) / len(measured) if measured \
+            else config.balancer_latency
+        return min(idle or available, key=lambda stats: stats.score(default))
 
     def next_url(self):
-        """Pop the next URL in line to be used with a request
+        """Pick the next URL to be used with a request
+
+        Each URL has to be handed back with 'release' once the request ends.
+
+        Returns:
+            str: server URL
         """
 
-        return str(next(self._urls))
+        stats = self._choose()
+        stats.outstanding += 1
+        return str(stats.url)
+
+    def rebase(self, url):
+        """Move a request URL to the next server in line
+
+        Used to retry a request on another server. The new URL has to be
+        handed back with 'release' once the request ends.
+
+        Args:
+            url (str): request URL
+
+        Returns:
+            str: the same request sent to another server
+        """
+
+        stats = self._choose()
+        stats.outstanding += 1
+        return str(URL(url).with_host(stats.url.host))
+
+    def release(self, url, latency=None, error=False):
+        """Report the outcome of a request made to a dispensed URL
+
+        Args:
+            url (str): request URL
+            latency (float, optional): response time in seconds.
+                Defaults to None.
+            error (bool, optional): request failed. Defaults to False.
+        """
+
+        stats = self._hosts.get(URL(url).host)
+        if stats is None:
+            return
+        stats.outstanding = max(stats.outstanding - 1, 0)
+        if latency is not None or error:
+            stats.record(latency, error)
+            metrics.registry.inc('api_requests_total',
+                                 server=stats.url.host,
+                                 outcome='error' if error else 'ok')
+        if latency is not None:
+            metrics.registry.observe('api_server_seconds',
+                                     latency,
+                                     server=stats.url.host)
 
 
 class Command:
@@ -104,7 +243,7 @@ class Command:
         """
 
         params = {
-            'command': 'getProfilePhotos',
+            'command': 'getProfile',
             'nick': nick,
             'actPath': f'/{nick}/',
             'token': token
@@ -174,13 +313,23 @@ class Command:
 class Ajax:
     """Create URLs for AJAX requests with the use of a balancer
 
-    Creates request URLs for available commands using a balancer to switch
-    after max number request has been made.
+    Creates request URLs for available commands using a balancer that sends
+    each request to the healthiest API server.
     """
 
     def __init__(self):
         self._balancer = Balancer()
 
+    @property
+    def balancer(self):
+        """Balancer used to choose API servers
+
+        Returns:
+            Balancer: server balancer
+        """
+
+        return self._balancer
+
     @property
     def _url(self):
         return self._balancer.next_url()
@@ -0,0 +1,86 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""Caching of asynchronously produced results
+
+Used to share API responses and file system lookups between concurrent
+tasks, so the same expensive call is made only once.
+"""
+
+import time
+import asyncio
+from collections import OrderedDict
+
+
+class AsyncCache:
+    """Single-flight, memoized store of results of coroutines
+
+    Concurrent requests for the same key share one in-flight call. Finished
+    results are kept for a limited time and evicted in LRU order once the
+    cache grows past its size limit.
+    """
+
+    def __init__(self, maxsize=1024, ttl=600):
+        """Create a new cache
+
+        Args:
+            maxsize (int, optional): max number of results. Defaults to 1024.
+            ttl (int, optional): result lifetime in seconds. Defaults to 600.
+        """
+
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._results = OrderedDict()
+        self._pending = {}
+
+    def _store(self, key, future):
+        self._pending.pop(key, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        if self._maxsize <= 0:
+            return
+        self._results[key] = (time.monotonic() + self._ttl, future.result())
+        self._results.move_to_end(key)
+        while len(self._results) > self._maxsize:
+            self._results.popitem(last=False)
+
+    async def get(self, key, factory):
+        """Get a cached result or produce it using a coroutine factory
+
+        Args:
+            key (Hashable): cache key
+            factory (Callable): returns a coroutine producing the result
+
+        Returns:
+            object: cached or freshly produced result
+        """
+
+        result = self._results.get(key)
+        if result is not None:
+            expires, value = result
+            if expires > time.monotonic():
+                self._results.move_to_end(key)
+                return value
+            del self._results[key]
+
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self._pending[key] = future
+            future.add_done_callback(lambda f: self._store(key, f))
+        return await asyncio.shield(future)
+
+    def peek(self, key):
+        """Get a cached result without producing it
+
+        Args:
+            key (Hashable): cache key
+
+        Returns:
+            object: cached result or None if not cached or expired
+        """
+
+        result = self._results.get(key)
+        if result is None or result[0] <= time.monotonic():
+            return None
+        return result[1]
@@ -12,14 +12,94 @@ import os
 
 host = 'zbiornik.com'
 scheme = 'https'
+port = None
+addresses = {}
 api_servers = ('dzesika', 'brajanek', 'vaneska', 'denisek')
 api_root = '/ajax/'
 request_headers = {
     'User-Agent': 'Mozilla/5.0',
 }
+api_connector = {
+    'limit_per_host': 0,
+    'ttl_dns_cache': 600,
+    'keepalive_timeout': 60,
+}
+media_connector = {
+    'limit_per_host': 0,
+    'ttl_dns_cache': 300,
+    'keepalive_timeout': 30,
+}
+# ClientTimeout arguments - transfers may be long (and throttled by
+# download_rate), so media requests only time out when the socket stalls
+api_timeout = {
+    'total': 300,
+    'sock_connect': 30,
+}
+media_timeout = {
+    'total': None,
+    'sock_connect': 30,
+    'sock_read': 60,
+}
+warm_up_timeout = 5
 max_server_requests = 5
+balancer_decay = 0.2
+# latency in seconds assumed for API servers before any of them responds
+balancer_latency = 1.0
+breaker_failures = 5
+breaker_cooldown = 30
+retry_attempts = 5
+retry_delay = 1.0
+retry_max_delay = 60.0
+retry_statuses = (408, 425, 429, 500, 502, 503, 504)
 max_downloads = 10
+part_suffix = '.part'
+segments = 1
+segment_threshold = 64 * 1024 * 1024
+segment_suffix = '.seg'
+sink_buffer_size = 1024 * 1024
+fsync = 'never'
+dir_cache_size = 1024
+dir_cache_ttl = 3600
 max_api_requests = 50
+queue_size = 100
+profile_workers = 8
+listing_workers = 4
+info_workers = 20
+download_workers = max_downloads
+api_rate = 0
+host_rate = 0
+download_rate = 0
+info_cache_size = 1024
+info_cache_ttl = 600
+json_decoder = None
 root_dir = 'profiles'
 path_template = os.path.join('%d', '%p', '%t')
 name_template = '%t-%h.%e'
+sanitizer = None
+manifest_path = None
+session_file = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'kurek',
+    'session.json')
+session_ttl = 12 * 3600
+manifest_name = '.kurek.db'
+# WAL does not work on network file systems - DELETE is used with a queue
+manifest_journal = 'WAL'
+# seconds to wait for the manifest locked by other workers
+manifest_timeout = 60
+# items recorded in the manifest are committed in batches of this size or
+# after this many seconds
+manifest_batch = 100
+manifest_delay = 5
+dedup = False
+metrics_path = None
+metrics_format = 'json'
+metrics_interval = 10
+profile_path = None
+workers = 1
+queue_path = None
+job_lease = 300
+job_attempts = 3
+job_timeout = 60
+# profiles added to the job queue are inserted in batches of this size
+job_batch = 1000
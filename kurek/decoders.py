@@ -0,0 +1,89 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""JSON decoders for API responses
+
+Responses are decoded straight from bytes with the fastest library that is
+installed - orjson, then msgspec, then the standard json module. A decoder
+can also be chosen with config.json_decoder.
+"""
+
+import json
+import functools
+
+from kurek import config
+
+
+def _orjson():
+    import orjson
+    return orjson.loads
+
+
+def _msgspec():
+    import msgspec
+    decoder = msgspec.json.Decoder()
+
+    def loads(data):
+        try:
+            return decoder.decode(data)
+        except msgspec.DecodeError as exc:
+            raise ValueError(str(exc)) from exc
+
+    return loads
+
+
+def _stdlib():
+    return json.loads
+
+
+DECODERS = {
+    'orjson': _orjson,
+    'msgspec': _msgspec,
+    'json': _stdlib,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def decoder(name=None):
+    """Get a JSON decoding function
+
+    Args:
+        name (str, optional): 'orjson', 'msgspec' or 'json'. Defaults to
+            None - the first installed one.
+
+    Raises:
+        ValueError: unknown decoder
+        ImportError: chosen decoder is not installed
+
+    Returns:
+        Callable: function decoding bytes into Python objects, raises
+            ValueError on invalid data
+    """
+
+    if name is not None:
+        if name not in DECODERS:
+            raise ValueError(f"unknown JSON decoder '{name}' (allowed: "
+                             f"{', '.join(DECODERS)})")
+        return DECODERS[name]()
+    for factory in DECODERS.values():
+        try:
+            return factory()
+        except ImportError:
+            continue
+    return _stdlib()
+
+
+def loads(data):
+    """Decode JSON data with the configured decoder
+
+    Args:
+        data (bytes): JSON document
+
+    Raises:
+        ValueError: invalid JSON
+
+    Returns:
+        object: decoded document
+    """
+
+    return decoder(config.json_decoder)(data)
@@ -0,0 +1,121 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""Deduplication of media shared between profiles
+
+The same media often shows up under several profiles. Saved files are
+indexed in the manifest by the path of their source URL and by a hash of
+their contents computed while they are received. Media with a known source
+is not downloaded again - the saved file is hard linked (or reflinked or
+copied) to the new path. Downloaded files with known contents are replaced
+with links as well, so they take disk space only once.
+"""
+
+import os
+import asyncio
+from urllib.parse import urlsplit
+
+from kurek import metrics
+from kurek.files import clone
+from kurek.manifest import Manifest
+
+
+def source(url):
+    """Identify media by its URL
+
+    Host names and query strings are left out - the same file may be
+    served by several hosts and with different access parameters.
+
+    Args:
+        url (str): media URL
+
+    Returns:
+        str: URL path
+    """
+
+    return urlsplit(url).path
+
+
+class DedupIndex:
+    """Media index kept in the manifest
+    """
+
+    def __init__(self, manifest: Manifest):
+        """Create an index
+
+        Args:
+            manifest (Manifest): database holding the index
+        """
+
+        self._manifest = manifest
+        self._pending = {}
+
+    async def download(self, session, item, path):
+        """Save an item, reusing a file with the same media if possible
+
+        Items of the same source saved at the same time are downloaded
+        once - the others wait for the transfer and reuse its file.
+
+        Args:
+            session (kurek.http.Session): http request session
+            item (kurek.json.Item): item with a known URL
+            path (str): path to save the file to
+
+        Returns:
+            str: 'link', 'reflink' or 'copy' if an existing file was reused,
+                None if the item was downloaded
+        """
+
+        key = source(item.url)
+        while True:
+            while (pending := self._pending.get(key)) is not None:
+                # the transfer may fail - then the next waiter takes over
+                await pending
+            method = await self._reuse(session.fs, key, path)
+            if method is not None:
+                return method
+            if key not in self._pending:
+                break
+        pending = self._pending[key] = \
+            asyncio.get_running_loop().create_future()
+        try:
+            digest = await session.download(item.url,
+                                            path,
+                                            item.segmented,
+                                            digest=True)
+            await self._add(session.fs, key, digest, path)
+        finally:
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+            pending.set_result(None)
+        return None
+
+    async def _reuse(self, fs, key, path):
+        manifest = self._manifest
+        known = await manifest.run(manifest.media, key)
+        if known is None:
+            return None
+        known_path, size = known
+        if known_path == path:
+            return None
+        if await fs.size(known_path) != size:
+            # the file was moved or deleted since it was indexed
+            await manifest.run(manifest.forget_media, key)
+            return None
+        await fs.makedirs(os.path.dirname(path))
+        method = await fs.run(clone, known_path, path)
+        fs.added(path)
+        metrics.registry.inc('items_skipped_total', reason='dedup')
+        metrics.registry.inc('dedup_bytes_total', size)
+        return method
+
+    async def _add(self, fs, key, digest, path):
+        size = await fs.size(path)
+        manifest = self._manifest
+        same = await manifest.run(manifest.media_by_digest, digest)
+        if same is not None and same[0] != path and \
+                await fs.size(same[0]) == same[1] == size:
+            # different source, same contents - keep a single copy
+            await fs.run(clone, same[0], path)
+            metrics.registry.inc('dedup_bytes_total', size)
+        await manifest.run(manifest.add_media, key, digest, path, size)
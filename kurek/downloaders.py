@@ -7,10 +7,32 @@ Downloader classes take in profile data or top list data and then start
 the downloads concurrently.
 """
 
+import sqlite3
 import asyncio
+import itertools
 
 from kurek import json
-from kurek.http import Session
+from kurek import config
+from kurek import metrics
+from kurek import profiling
+from kurek.http import Session, ResponseError, NETWORK_ERRORS
+from kurek.retry import RetryPolicy, describe
+from kurek.manifest import Manifest, fingerprint
+from kurek.plan import PlanWriter
+from kurek.jobs import JobQueue
+from kurek.dedup import DedupIndex
+
+
+# failures of a single listing or item - malformed API responses (e.g. an
+# error instead of a listing), file system errors (e.g. a name too long) and
+# a manifest locked by other workers fail the item only, not the whole run
+ITEM_ERRORS = NETWORK_ERRORS + (ResponseError, OSError, sqlite3.Error)
+
+
+def _reason(exc):
+    if isinstance(exc, NETWORK_ERRORS):
+        return describe(exc)
+    return f'{type(exc).__name__}: {describe(exc)}'
 
 
 # TODO: use proper interface (virtual class)
@@ -27,19 +49,154 @@ class Downloader:
 
         _ = (session)
 
+    @staticmethod
+    async def _worker(queue, handler):
+        while True:
+            job = await queue.get()
+            try:
+                await handler(*job)
+            finally:
+                queue.task_done()
+
+    @staticmethod
+    async def _store(manifest, item, path, session):
+        # record a saved item, report if the manifest fails
+        try:
+            size = await session.fs.size(path)
+            await manifest.run(manifest.add, item, path, size or 0)
+        except ITEM_ERRORS as exc:
+            print(f'Failed to record {item.type} {item.uid} '
+                  f'of {item.owner}: {_reason(exc)}')
+            metrics.registry.inc('errors_total', stage='record')
+            return False
+        return True
+
+
+class ProfileJob:
+    """Profile being processed
+
+    Each profile holds a slot of the downloader until all of its listings
+    are finished.
+    """
+
+    def __init__(self, nick, listings, slots, jobs: JobQueue = None):
+        """Take a profile slot
+
+        Args:
+            nick (str): profile name
+            listings (int): number of listings to process
+            slots (asyncio.Semaphore): acquired profile slots
+            jobs (JobQueue, optional): queue the profile was claimed from.
+                Defaults to None.
+        """
+
+        self.nick = nick
+        self._listings = listings
+        self._slots = slots
+        self._jobs = jobs
+        self._failed = False
+
+    def done(self, failed=False):
+        """Mark one of profile's listings as finished
+
+        Args:
+            failed (bool, optional): listing was not fully downloaded.
+                Defaults to False.
+        """
+
+        self._failed = self._failed or failed
+        self._listings -= 1
+        if self._listings == 0:
+            if self._jobs is None:
+                self._slots.release()
+            else:
+                asyncio.ensure_future(self._complete())
+
+    async def _complete(self):
+        # the queue may be locked by another host - keep the loop running
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None,
+                                       self._jobs.complete,
+                                       self.nick,
+                                       self._failed)
+        except sqlite3.Error as exc:
+            # the lease expires and the profile is claimed again
+            print(f'Failed to complete profile {self.nick}: {exc}')
+        finally:
+            self._slots.release()
+
+
+class Listing:
+    """Progress of downloading a single profile listing
+    """
+
+    def __init__(self, profile, item_type, items):
+        """Start tracking a listing
+
+        Args:
+            profile (ProfileJob): profile the listing belongs to
+            item_type (str): item type (photo/video)
+            items (list): all items of the listing
+        """
+
+        self.profile = profile
+        self.owner = profile.nick
+        self.type = item_type
+        self.fingerprint = fingerprint(items)
+        self.count = len(items)
+        self.remaining = 0
+        self.failed = False
+
 
 class ProfileDownloader(Downloader):
     """Downloads media from a collection of profiles
+
+    Work is split into stages connected by bounded queues - listing
+    profiles, fetching item info, downloading and recording results. Each
+    stage runs a fixed number of workers, so the number of live items stays
+    bounded no matter how many profiles are processed. Only a limited number
+    of profiles is processed at a time.
+
+    With a plan writer resolved items are written to the plan instead of
+    being downloaded. With a job queue profiles are claimed from the queue
+    and their leases are renewed until they are finished.
     """
 
-    def __init__(self, nicks):
+    def __init__(self,
+                 nicks,
+                 manifest: Manifest = None,
+                 sync=False,
+                 plan: PlanWriter = None,
+                 jobs: JobQueue = None,
+                 dedup: DedupIndex = None):
         """Create a new downloader
 
         Args:
-            nicks (Iterable): a list of profile names
+            nicks (Iterable): profile names - iterated lazily, may block
+            manifest (Manifest, optional): completed downloads database.
+                Defaults to None.
+            sync (bool, optional): skip listings unchanged since the last
+                run (requires manifest). Defaults to False.
+            plan (PlanWriter, optional): write resolved items to a plan
+                instead of downloading them. Defaults to None.
+            jobs (JobQueue, optional): queue to claim profiles from - nicks
+                are ignored. Defaults to None.
+            dedup (DedupIndex, optional): reuse files with the same media.
+                Defaults to None.
         """
 
         self._nicks = nicks
+        self._manifest = manifest
+        self._sync = sync and manifest is not None and plan is None
+        self._plan = plan
+        self._jobs = jobs
+        self._dedup = dedup
+        self._slots = None
+        self._profiles = None
+        self._infos = None
+        self._downloads = None
+        self._results = None
 
     async def download(self, session: Session, photos=True, videos=True):
         """Start downloading data
@@ -50,33 +207,298 @@ class ProfileDownloader(Downloader):
             videos (bool, optional): download videos. Defaults to True.
         """
 
-        profiles = (json.Profile(nick) for nick in self._nicks)
-        tasks = (self._profile_task(profile, session, photos, videos)
-                 for profile in profiles)
-        await asyncio.gather(*tasks)
-
-    async def _photo_task(self, photo: json.Photo, session: Session):
-        await photo.download(session)
-
-    async def _video_task(self, video: json.Video, session: Session):
-        await video.fetch(session)
-        await video.download(session)
-
-    async def _profile_task(self,
-                            profile: json.Profile,
-                            session: Session,
-                            photos: bool,
-                            videos: bool):
-        photo_tasks = []
-        video_tasks = []
-
-        if photos:
-            await profile.photos.fetch(session)
-            photo_tasks = (self._photo_task(photo, session)
-                           for photo in profile.photos.items)
-        if videos:
-            await profile.videos.fetch(session)
-            video_tasks = (self._video_task(video, session)
-                           for video in profile.videos.items)
-
-        await asyncio.gather(*photo_tasks, *video_tasks)
+        types = [item_type
+                 for item_type, enabled in (('photo', photos),
+                                            ('video', videos))
+                 if enabled]
+        save = self._save if self._plan is None else self._write_plan
+        self._slots = asyncio.Semaphore(config.profile_workers)
+        self._profiles = asyncio.Queue(config.queue_size)
+        self._infos = asyncio.Queue(config.queue_size)
+        self._downloads = asyncio.Queue(config.queue_size)
+        self._results = asyncio.Queue(config.queue_size)
+        stages = (
+            (self._profiles, config.listing_workers,
+             lambda profile: self._list(profile, types, session)),
+            (self._infos, config.info_workers,
+             lambda listing, item: self._resolve(listing, item, session)),
+            (self._downloads, config.download_workers,
+             lambda listing, item: save(listing, item, session)),
+            (self._results, 1,
+             lambda listing, item, path: self._record(listing,
+                                                      item,
+                                                      path,
+                                                      session)),
+        )
+        for name, (queue, _, _) in zip(('profiles', 'infos', 'downloads',
+                                        'results'), stages):
+            metrics.registry.gauge('queue_depth', queue.qsize, stage=name)
+        workers = [asyncio.ensure_future(self._worker(queue, handler))
+                   for queue, count, handler in stages
+                   for _ in range(max(count, 1))]
+        done = asyncio.ensure_future(self._feed(len(types),
+                                                [queue
+                                                 for queue, _, _ in stages]))
+        if self._jobs is not None:
+            workers.append(asyncio.ensure_future(self._renew()))
+        try:
+            # workers only finish by raising - surface unexpected errors,
+            # including errors of reading profile names
+            await asyncio.wait([done, *workers],
+                               return_when=asyncio.FIRST_COMPLETED)
+            for task in (done, *workers):
+                if task.done():
+                    task.result()
+        finally:
+            for task in (done, *workers):
+                task.cancel()
+            await asyncio.gather(done, *workers, return_exceptions=True)
+
+    async def _renew(self):
+        # keep leases of claimed profiles alive while they are processed
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self._jobs.lease / 3)
+            try:
+                await loop.run_in_executor(None, self._jobs.renew)
+            except sqlite3.Error as exc:
+                # the queue may stay locked for a while - try again later,
+                # leases last long enough to miss a renewal
+                print(f'Failed to renew job leases: {exc}')
+                metrics.registry.inc('errors_total', stage='renew')
+
+    async def _feed(self, listings, queues):
+        # nicks may come from a blocking source (e.g. stdin)
+        loop = asyncio.get_running_loop()
+        nicks = iter(self._nicks)
+        while True:
+            await self._slots.acquire()
+            if self._jobs is None:
+                nick = await loop.run_in_executor(None, next, nicks, None)
+            else:
+                nick = await self._claim()
+            if nick is None:
+                self._slots.release()
+                break
+            profile = ProfileJob(nick, listings, self._slots, self._jobs)
+            await self._profiles.put((profile,))
+        for queue in queues:
+            await queue.join()
+        # every slot is back once all profiles are completed
+        for _ in range(config.profile_workers):
+            await self._slots.acquire()
+
+    async def _claim(self):
+        # the queue may be locked by another host - back off and try again
+        loop = asyncio.get_running_loop()
+        backoff = RetryPolicy(1, config.retry_delay, config.retry_max_delay)
+        for attempt in itertools.count():
+            try:
+                return await loop.run_in_executor(None, self._jobs.claim)
+            except sqlite3.Error as exc:
+                print(f'Failed to claim a profile: {exc}')
+                metrics.registry.inc('errors_total', stage='claim')
+            await asyncio.sleep(backoff.delay(attempt))
+
+    async def _pending(self, owner, item_type, items):
+        if self._manifest is None:
+            return items
+        manifest = self._manifest
+        done = await manifest.run(manifest.uids, owner, item_type)
+        return [item for item in items if item.uid not in done]
+
+    async def _list(self, job, types, session):
+        nick = job.nick
+        profile = json.Profile(nick)
+        collections = {'photo': profile.photos, 'video': profile.videos}
+        for item_type in types:
+            collection = collections[item_type]
+            try:
+                with profiling.span('listing', 'api',
+                                    profile=nick, type=item_type):
+                    await collection.fetch(session)
+                listing = Listing(job, item_type, collection.items)
+                unchanged = self._sync and listing.fingerprint == \
+                    await self._manifest.run(self._manifest.watermark,
+                                             nick,
+                                             item_type)
+                if not unchanged:
+                    items = await self._pending(nick,
+                                                item_type,
+                                                collection.items)
+            except ITEM_ERRORS as exc:
+                reason = _reason(exc)
+                print(f'Failed to list {item_type}s of {nick}: {reason}')
+                metrics.registry.inc('errors_total', stage='list')
+                job.done(failed=True)
+                continue
+            if unchanged:
+                print(f'No new {item_type}s in profile {nick}. Skipping.')
+                metrics.registry.inc('items_skipped_total',
+                                     listing.count,
+                                     reason='sync')
+                job.done()
+                continue
+            metrics.registry.inc('items_skipped_total',
+                                 listing.count - len(items),
+                                 reason='manifest')
+            collection.items = None
+            listing.remaining = len(items)
+            if not items:
+                await self._finish(listing)
+            for item in items:
+                await self._infos.put((listing, item))
+
+    async def _resolve(self, listing, item, session):
+        try:
+            with profiling.span('item info', 'api', uid=item.uid):
+                await item.fetch(session)
+        except ITEM_ERRORS as exc:
+            reason = _reason(exc)
+            print(f'Failed to get info of {item.type} {item.uid} '
+                  f'of {item.owner}: {reason}')
+            metrics.registry.inc('errors_total', stage='info')
+            await self._results.put((listing, item, None))
+            return
+        await self._downloads.put((listing, item))
+
+    async def _save(self, listing, item, session):
+        try:
+            path = await item.download(session, self._dedup)
+        except ITEM_ERRORS as exc:
+            reason = _reason(exc)
+            print(f'Failed to download {item.type} {item.uid} '
+                  f'of {item.owner}: {reason}')
+            metrics.registry.inc('errors_total', stage='download')
+            path = None
+        await self._results.put((listing, item, path))
+
+    async def _write_plan(self, listing, item, _):
+        path = None
+        try:
+            self._plan.write(item)
+            path = item.path
+        except (OSError, ValueError) as exc:
+            print(f'Failed to plan {item.type} {item.uid} '
+                  f'of {item.owner}: {exc}')
+            metrics.registry.inc('errors_total', stage='plan')
+        await self._results.put((listing, item, path))
+
+    async def _record(self, listing, item, path, session):
+        metrics.registry.inc('items_total',
+                             type=item.type,
+                             outcome='error' if path is None else 'ok')
+        if path is None:
+            listing.failed = True
+        elif self._manifest is not None and self._plan is None:
+            if not await self._store(self._manifest, item, path, session):
+                listing.failed = True
+        listing.remaining -= 1
+        if listing.remaining == 0:
+            await self._finish(listing)
+
+    async def _finish(self, listing):
+        if self._sync and not listing.failed:
+            try:
+                await self._manifest.run(self._manifest.set_watermark,
+                                         listing.owner,
+                                         listing.type,
+                                         listing.fingerprint,
+                                         listing.count)
+            except sqlite3.Error as exc:
+                print(f'Failed to record {listing.type}s of '
+                      f'{listing.owner}: {exc}')
+                metrics.registry.inc('errors_total', stage='record')
+                listing.failed = True
+        listing.profile.done(listing.failed)
+
+
+class PlanDownloader(Downloader):
+    """Downloads items of a plan
+
+    No API requests are made - plans hold final URLs and paths. Items are
+    read lazily and passed to a fixed number of download workers.
+    """
+
+    def __init__(self,
+                 items,
+                 manifest: Manifest = None,
+                 dedup: DedupIndex = None):
+        """Create a new downloader
+
+        Args:
+            items (Iterable): planned items - iterated lazily, may block
+            manifest (Manifest, optional): completed downloads database.
+                Defaults to None.
+            dedup (DedupIndex, optional): reuse files with the same media.
+                Defaults to None.
+        """
+
+        self._items = items
+        self._manifest = manifest
+        self._dedup = dedup
+        self._downloads = None
+
+    async def download(self, session: Session):
+        """Start downloading data
+
+        Args:
+            session (Session): http session
+        """
+
+        self._downloads = asyncio.Queue(config.queue_size)
+        workers = [asyncio.ensure_future(
+                       self._worker(self._downloads,
+                                    lambda item: self._save(item, session)))
+                   for _ in range(max(config.download_workers, 1))]
+        done = asyncio.ensure_future(self._feed())
+        try:
+            await asyncio.wait([done, *workers],
+                               return_when=asyncio.FIRST_COMPLETED)
+            for task in (done, *workers):
+                if task.done():
+                    task.result()
+        finally:
+            for task in (done, *workers):
+                task.cancel()
+            await asyncio.gather(done, *workers, return_exceptions=True)
+
+    async def _feed(self):
+        loop = asyncio.get_running_loop()
+        items = iter(self._items)
+        while True:
+            item = await loop.run_in_executor(None, next, items, None)
+            if item is None:
+                break
+            if await self._known(item):
+                metrics.registry.inc('items_skipped_total', reason='manifest')
+                continue
+            await self._downloads.put((item,))
+        await self._downloads.join()
+
+    async def _known(self, item):
+        if self._manifest is None:
+            return False
+        try:
+            return await self._manifest.run(self._manifest.has, item.uid)
+        except sqlite3.Error as exc:
+            # download it - a saved file is skipped anyway
+            print(f'Failed to check {item.type} {item.uid} '
+                  f'of {item.owner}: {exc}')
+            metrics.registry.inc('errors_total', stage='record')
+            return False
+
+    async def _save(self, item, session):
+        try:
+            path = await item.download(session, self._dedup)
+        except ITEM_ERRORS as exc:
+            reason = _reason(exc)
+            print(f'Failed to download {item.type} {item.uid} '
+                  f'of {item.owner}: {reason}')
+            metrics.registry.inc('errors_total', stage='download')
+            path = None
+        metrics.registry.inc('items_total',
+                             type=item.type,
+                             outcome='error' if path is None else 'ok')
+        if path is not None and self._manifest is not None:
+            await self._store(self._manifest, item, path, session)
@@ -0,0 +1,336 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""File system helpers used while saving downloaded data
+
+Blocking file system calls are run in an executor, so slow disks and
+network file systems do not stall the event loop.
+
+Network data arrives in small chunks. FileSink collects them in large
+reusable buffers and writes each full buffer with a positional write run in
+an executor, so a download costs one thread pool round trip per buffer
+instead of one per chunk.
+"""
+
+import os
+import shutil
+import asyncio
+import hashlib
+
+from kurek import config
+from kurek import profiling
+from kurek.cache import AsyncCache
+
+
+_buffers = []
+
+
+def _pwrite(fd, data, position):
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, data, position)
+    os.lseek(fd, position, os.SEEK_SET)
+    return os.write(fd, data)
+
+
+def preallocate(fd, offset, length):
+    """Reserve disk space for data that will be written to a file
+
+    Does nothing on platforms without posix_fallocate.
+
+    Args:
+        fd (int): file descriptor
+        offset (int): first byte of the reserved region
+        length (int): number of bytes
+    """
+
+    if length > 0 and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, offset, length)
+        except OSError:
+            # not supported by the file system - data is written anyway
+            pass
+
+
+# Linux ioctl sharing data blocks of two files (btrfs, XFS)
+FICLONE = 0x40049409
+
+
+def content_hash():
+    """Create a hash object used to identify file contents
+
+    Returns:
+        hashlib object: empty SHA-256 hash
+    """
+
+    return hashlib.sha256()
+
+
+def hash_file(path, size=None):
+    """Hash the contents of a file
+
+    Args:
+        path (str): file path
+        size (int, optional): hash only the first size bytes.
+            Defaults to None - the whole file.
+
+    Returns:
+        hashlib object: hash that can be updated with further data
+    """
+
+    hasher = content_hash()
+    remaining = size
+    with open(path, 'rb') as file:
+        while remaining is None or remaining > 0:
+            chunk = config.sink_buffer_size
+            if remaining is not None:
+                chunk = min(chunk, remaining)
+                remaining -= chunk
+            data = file.read(chunk)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher
+
+
+def _reflink(source, target):
+    import fcntl
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def clone(source, target):
+    """Make a file with the same contents as another one
+
+    A hard link is made if possible. Otherwise the data is shared with a
+    reflink on file systems that support it or copied.
+
+    Args:
+        source (str): existing file
+        target (str): new file, replaced if it exists
+
+    Returns:
+        str: method used - 'link', 'reflink' or 'copy'
+    """
+
+    temp = target + config.part_suffix
+    if os.path.lexists(temp):
+        os.remove(temp)
+    try:
+        os.link(source, temp)
+        method = 'link'
+    except OSError:
+        try:
+            _reflink(source, temp)
+            method = 'reflink'
+        except (OSError, ImportError):
+            shutil.copyfile(source, temp)
+            method = 'copy'
+    os.replace(temp, target)
+    return method
+
+
+class FileSystem:
+    """Asynchronous file system access with directory caching
+
+    Directories known to exist are remembered, so they are created at most
+    once. Existence checks of files are answered from a single listing of
+    their directory instead of a stat call per file.
+    """
+
+    def __init__(self):
+        self._dirs = AsyncCache(config.dir_cache_size, config.dir_cache_ttl)
+        self._listings = AsyncCache(config.dir_cache_size,
+                                    config.dir_cache_ttl)
+
+    @staticmethod
+    async def run(function, *args):
+        """Run a blocking function in the default executor
+
+        Args:
+            function (Callable): blocking function
+            *args: function arguments
+
+        Returns:
+            object: function result
+        """
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, function, *args)
+
+    async def makedirs(self, path):
+        """Make sure a directory exists
+
+        Args:
+            path (str): directory path
+        """
+
+        if path:
+            await self._dirs.get(path, lambda: self.run(_makedirs, path))
+
+    async def exists(self, path):
+        """Check if a file exists
+
+        Args:
+            path (str): file path
+
+        Returns:
+            bool: file exists
+        """
+
+        directory, name = os.path.split(path)
+        names = await self._listings.get(directory,
+                                         lambda: self.run(_listdir, directory))
+        return name in names
+
+    def added(self, path):
+        """Register a file created by this process in cached listings
+
+        Args:
+            path (str): file path
+        """
+
+        directory, name = os.path.split(path)
+        names = self._listings.peek(directory)
+        if names is not None:
+            names.add(name)
+
+    async def size(self, path):
+        """Get size of a file
+
+        Args:
+            path (str): file path
+
+        Returns:
+            int: file size or None if the file does not exist
+        """
+
+        try:
+            return await self.run(os.path.getsize, path)
+        except FileNotFoundError:
+            return None
+
+
+def _makedirs(path):
+    os.makedirs(path, exist_ok=True)
+    return True
+
+
+def _listdir(path):
+    try:
+        with os.scandir(path or '.') as entries:
+            return {entry.name for entry in entries}
+    except FileNotFoundError:
+        return set()
+
+
+class FileSink:
+    """Buffered writer of a file region
+
+    Data is written at increasing positions starting from a given offset,
+    so several sinks can fill different regions of the same file.
+    """
+
+    def __init__(self, fd, offset=0, buffer_size=None, fsync=None):
+        """Create a new sink
+
+        Args:
+            fd (int): file descriptor open for writing
+            offset (int, optional): position of the first byte.
+                Defaults to 0.
+            buffer_size (int, optional): size of the write buffer.
+                Defaults to config.sink_buffer_size.
+            fsync (str, optional): 'never', 'close' or 'always' (after
+                every buffer). Defaults to config.fsync.
+        """
+
+        self._fd = fd
+        self._position = offset
+        self._size = buffer_size or config.sink_buffer_size
+        self._fsync = fsync or config.fsync
+        self._buffer = None
+        self._used = 0
+
+    @property
+    def position(self):
+        """Position after the last byte written so far (buffered included)
+
+        Returns:
+            int: file position
+        """
+
+        return self._position + self._used
+
+    def _write(self, data, position):
+        view = memoryview(data)
+        while view:
+            written = _pwrite(self._fd, view, position)
+            view = view[written:]
+            position += written
+        if self._fsync == 'always':
+            os.fsync(self._fd)
+
+    async def _flush(self, data):
+        loop = asyncio.get_running_loop()
+        with profiling.span('disk write', 'disk', bytes=len(data)):
+            write = loop.run_in_executor(None,
+                                         self._write,
+                                         data,
+                                         self._position)
+            try:
+                await asyncio.shield(write)
+            except asyncio.CancelledError:
+                # a started write cannot be stopped - the descriptor must
+                # stay open until it is finished
+                await asyncio.wait([write])
+                raise
+        self._position += len(data)
+
+    async def write(self, data):
+        """Write data to the file, buffering it if possible
+
+        Args:
+            data (bytes): data to write
+        """
+
+        if self._buffer is None:
+            self._buffer = _buffers.pop() if _buffers else None
+            if self._buffer is None or len(self._buffer) != self._size:
+                self._buffer = bytearray(self._size)
+        size = len(data)
+        if self._used + size > self._size:
+            await self.flush()
+        if size >= self._size:
+            await self._flush(data)
+            return
+        self._buffer[self._used:self._used + size] = data
+        self._used += size
+
+    async def flush(self):
+        """Write buffered data to the file
+        """
+
+        if self._used:
+            await self._flush(memoryview(self._buffer)[:self._used])
+            self._used = 0
+
+    async def close(self):
+        """Flush buffered data and give the buffer back for reuse
+
+        The file descriptor stays open.
+        """
+
+        try:
+            await self.flush()
+            if self._fsync == 'close':
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, os.fsync, self._fd)
+        finally:
+            if self._buffer is not None:
+                _buffers.append(self._buffer)
+                self._buffer = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
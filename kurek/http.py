@@ -8,15 +8,71 @@ helper classes to deal with session parameters.
 """
 
 import os
+import json
+import time
+import codecs
+import socket
 import asyncio
+import tempfile
+from html.parser import HTMLParser
+from http.cookies import SimpleCookie
 
-import aiofiles
 from yarl import URL
-from bs4 import BeautifulSoup
-from aiohttp import ClientSession
+from aiohttp import ClientSession, ClientError, ClientResponseError, \
+    ClientTimeout, CookieJar, TCPConnector
+from aiohttp.abc import AbstractResolver
+from aiohttp.resolver import DefaultResolver
 
 from kurek import config
+from kurek import metrics
+from kurek import decoders
+from kurek import profiling
 from kurek.ajax import Ajax
+from kurek.limits import TokenBucket, HostBuckets
+from kurek.retry import RetryPolicy
+from kurek.cache import AsyncCache
+from kurek.files import FileSink, FileSystem, preallocate, content_hash, \
+    hash_file
+
+
+class DownloadError(Exception):
+    """Downloaded data is inconsistent with server response
+    """
+
+
+class ResponseError(Exception):
+    """API response is not valid JSON or lacks expected fields
+    """
+
+
+NETWORK_ERRORS = (ClientError, asyncio.TimeoutError, DownloadError)
+
+
+def _endpoint(url):
+    return URL(url).query.get('command', '')
+
+
+def _content_range(headers):
+    """Parse Content-Range header into first byte and total size
+
+    Args:
+        headers (Mapping): response headers
+
+    Returns:
+        tuple: first byte position and total size (None if unknown)
+    """
+
+    value = headers.get('Content-Range', '')
+    _, _, spec = value.partition(' ')
+    span, _, total = spec.partition('/')
+    start = span.partition('-')[0]
+    return (int(start) if start.isdecimal() else None,
+            int(total) if total.isdecimal() else None)
+
+
+def _discard(fd, path):
+    os.close(fd)
+    os.remove(path)
 
 
 class User:
@@ -87,6 +143,17 @@ class User:
         self._nick = json['loggedUser']['nick']
         print(f'User {self.nick} logged in. [token: {self.token}]')
 
+    def restore(self, nick, token):
+        """Restore login status saved by a previous session
+
+        Args:
+            nick (str): user's profile name
+            token (str): session token
+        """
+
+        self._nick = nick
+        self._token = token
+
 
 class Site:
     """Main site operations
@@ -102,32 +169,180 @@ class Site:
         """
 
         self._url = str(URL.build(scheme=config.scheme,
-                                  host=config.host))
+                                  host=config.host,
+                                  port=config.port))
         self._client = client
 
-    async def _get_html_text(self):
-        async with self._client.get(self._url) as response:
-            response.raise_for_status()
-            html = await response.text()
-        return html
-
     async def get_tag_property_by_id(self, tag_id, field='value'):
         """Get value of a field from a tag represented by id
 
+        The page is parsed while it is being received and the download stops
+        as soon as the tag is found.
+
         Args:
             tag_id (str): html id of the tag
             field (str, optional): field name. Defaults to 'value'.
 
+        Raises:
+            LookupError: tag or field not found
+
         Returns:
             str: tag field value
         """
 
-        soup = BeautifulSoup(await self._get_html_text(), 'html.parser')
-        return soup.find(id=tag_id)[field]
+        finder = TagFinder(tag_id)
+        async with self._client.get(self._url) as response:
+            response.raise_for_status()
+            charset = response.charset or 'utf-8'
+            decoder = codecs.getincrementaldecoder(charset)(errors='replace')
+            async for chunk in response.content.iter_chunked(2**14):
+                finder.feed(decoder.decode(chunk))
+                if finder.attrs is not None:
+                    break
+        if finder.attrs is None:
+            raise LookupError(f"Tag '{tag_id}' not found at {self._url}.")
+        return finder.attrs[field]
+
+
+class TagFinder(HTMLParser):
+    """Incremental HTML parser looking for a tag with a given id
+    """
+
+    def __init__(self, tag_id):
+        """Create a new parser
+
+        Args:
+            tag_id (str): html id of the tag
+        """
+
+        super().__init__()
+        self._id = tag_id
+        self.attrs = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.attrs is None:
+            attrs = dict(attrs)
+            if attrs.get('id') == self._id:
+                self.attrs = attrs
+
+
+class SessionStore:
+    """Saved login session
+
+    Keeps the session token and cookies in a file readable only by its
+    owner, so that subsequent runs can skip logging in.
+    """
+
+    def __init__(self, path, ttl):
+        """Create a store backed by a file
+
+        Args:
+            path (str): session file path
+            ttl (float): lifetime of a saved session in seconds
+        """
+
+        self._path = path
+        self._ttl = ttl
+
+    def load(self, email):
+        """Load a saved session
+
+        Args:
+            email (str): account email the session belongs to
+
+        Returns:
+            dict: saved session or None if missing, expired or invalid
+        """
+
+        try:
+            with open(self._path, 'r', encoding='utf-8') as file:
+                saved = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(saved, dict) or saved.get('email') != email \
+                or saved.get('expires', 0) < time.time():
+            return None
+        return saved
+
+    def save(self, user, cookies):
+        """Save a logged in session
+
+        Args:
+            user (User): logged in user
+            cookies (aiohttp.abc.AbstractCookieJar): session cookies
+        """
+
+        saved = {
+            'email': user.email,
+            'nick': user.nick,
+            'token': user.token,
+            'cookies': [morsel.OutputString() for morsel in cookies],
+            'expires': time.time() + self._ttl,
+        }
+        save_dir = os.path.dirname(self._path)
+        if save_dir:
+            os.makedirs(save_dir, mode=0o700, exist_ok=True)
+        # a new file (O_EXCL, owner-only) - never reuse a leftover one
+        fd, temp = tempfile.mkstemp(prefix=os.path.basename(self._path) + '.',
+                                    suffix='.tmp',
+                                    dir=save_dir or None)
+        try:
+            with open(fd, 'w', encoding='utf-8') as file:
+                json.dump(saved, file)
+            os.replace(temp, self._path)
+        except BaseException:
+            os.remove(temp)
+            raise
+
+    def clear(self):
+        """Remove the saved session
+        """
+
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+
+class StaticResolver(AbstractResolver):
+    """Resolver with fixed addresses of chosen hosts
+
+    Other hosts are resolved with the default resolver. Used to point the
+    site and API hosts at a local server.
+    """
+
+    def __init__(self, addresses):
+        """Create a new resolver
+
+        Args:
+            addresses (dict): host name to IP address mapping
+        """
+
+        self._addresses = addresses
+        self._resolver = DefaultResolver()
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        address = self._addresses.get(host)
+        if address is None:
+            return await self._resolver.resolve(host, port, family)
+        family = socket.AF_INET6 if ':' in address else socket.AF_INET
+        return [{'hostname': host,
+                 'host': address,
+                 'port': port,
+                 'family': family,
+                 'proto': 0,
+                 'flags': socket.AI_NUMERICHOST}]
+
+    async def close(self):
+        await self._resolver.close()
 
 
 class Session:
     """Session information and http request handler / limiter
+
+    API requests and media downloads use separate connection pools, so
+    small API calls never wait for a connection held by a large transfer.
+    Both pools share cookies.
     """
 
     def __init__(self, api_limit=0, download_limit=0, headers=None):
@@ -140,17 +355,32 @@ class Session:
         """
 
         self._client: ClientSession = None
+        self._media: ClientSession = None
         self._ajax: Ajax = Ajax()
         self._user: User = None
         self._api_limit = api_limit
         self._download_limit = download_limit
         self._api_limiter = None
         self._download_limiter = None
+        self._api_rate = None
+        self._bandwidth = None
+        self._host_rate = None
+        self._retry = RetryPolicy(config.retry_attempts,
+                                  config.retry_delay,
+                                  config.retry_max_delay,
+                                  config.retry_statuses,
+                                  NETWORK_ERRORS)
         self._headers = headers
+        self._fs = FileSystem()
+        self._info_cache = AsyncCache(config.info_cache_size,
+                                      config.info_cache_ttl)
 
     async def get(self, url):
         """Make GET request
 
+        Failed requests are retried on other API servers according to
+        the retry policy.
+
         Args:
             url (str): request URL
 
@@ -158,59 +388,369 @@ class Session:
             dict: response JSON object
         """
 
-        async with self._api_limiter:
-            async with self._client.get(url) as response:
-                response.raise_for_status()
-                json = await response.json(content_type=None)
+        async def attempt(number):
+            nonlocal url
+            if number:
+                metrics.registry.inc('api_retries_total')
+                url = self._ajax.balancer.rebase(url)
+            return await self._get(url)
+
+        return await self._retry.call(attempt)
+
+    async def _get(self, url):
+        latency, error = None, False
+        try:
+            with profiling.span('api throttle', 'wait'):
+                await self._api_rate.acquire()
+                await self._host_rate.acquire(URL(url).host)
+            async with self._api_limiter:
+                started = time.monotonic()
+                with profiling.span('api request', 'network',
+                                    endpoint=_endpoint(url)):
+                    async with self._client.get(url) as response:
+                        response.raise_for_status()
+                        data = await response.read()
+                latency = time.monotonic() - started
+            # decoded from bytes after the request slot is given back
+            with profiling.span('decode', 'cpu', bytes=len(data)):
+                try:
+                    json = decoders.loads(data)
+                except ValueError as exc:
+                    # e.g. an HTML error page
+                    raise ResponseError(f'Malformed {_endpoint(url)} '
+                                        f'response: {exc}') from exc
+        except Exception as exc:
+            error = self._retry.retryable(exc)
+            metrics.registry.inc('api_errors_total',
+                                 endpoint=_endpoint(url),
+                                 reason=type(exc).__name__)
+            raise
+        finally:
+            self._ajax.balancer.release(url, latency, error)
+        metrics.registry.observe('api_request_seconds',
+                                 latency,
+                                 endpoint=_endpoint(url))
         return json
 
-    async def download(self, url, path):
+    async def download(self, url, path, segmented=False, digest=False):
         """Download data and save to file
 
+        Data is streamed to a temporary '.part' file which is renamed once
+        complete. An existing '.part' file left by an interrupted run is
+        resumed with a Range request. Large files can be fetched in several
+        byte ranges at once - each segment takes a download slot.
+
         Args:
             url (str): request URL
             path (path): file to save to
+            segmented (bool, optional): allow fetching large files in
+                segments. Defaults to False.
+            digest (bool, optional): compute the content hash of the file
+                while it is received. Defaults to False.
+
+        Raises:
+            DownloadError: saved data does not match the size reported
+                by the server
+
+        Returns:
+            str: hex digest of the file or None if not requested
         """
 
+        started = time.monotonic()
+        outcome = 'error'
+        try:
+            await self._fs.makedirs(os.path.dirname(path))
+            size = None
+            if segmented and config.segments > 1:
+                size = await self._retry.call(
+                    lambda _: self._segmented_size(url, path))
+            if size is None:
+                result = await self._retry.call(
+                    lambda _: self._download(url, path, digest))
+            else:
+                # ranges are retried one by one - retrying the whole
+                # download would fetch the completed ranges again
+                result = await self._download_segmented(url,
+                                                        path,
+                                                        size,
+                                                        digest)
+            outcome = 'ok'
+            return result
+        finally:
+            metrics.registry.inc('downloads_total', outcome=outcome)
+            metrics.registry.observe('download_seconds',
+                                     time.monotonic() - started,
+                                     metrics.DURATION_BUCKETS)
+
+    async def _segmented_size(self, url, path):
+        # size of a file worth fetching in segments, None to use one stream
+        if await self._fs.size(path + config.part_suffix) is not None:
+            return None
+        size = await self._probe_size(url)
+        if size is None or size < config.segment_threshold:
+            return None
+        return size
+
+    async def _download(self, url, path, digest):
+        part = path + config.part_suffix
+        offset = await self._fs.size(part) or 0
+        hasher = None
+        if digest:
+            # data of an interrupted run is hashed before it is extended
+            hasher = await self._fs.run(hash_file, part) if offset \
+                else content_hash()
+        headers = {'Range': f'bytes={offset}-'} if offset else None
+
+        await self._host_rate.acquire(URL(url).host)
+        async with self._download_limiter, \
+                profiling.span('download', 'network', path=path):
+            async with self._media.get(url, headers=headers) as response:
+                if response.status == 416 and offset:
+                    # nothing left to fetch if the part file is complete
+                    _, total = _content_range(response.headers)
+                    if total != offset:
+                        await self._fs.run(os.remove, part)
+                        raise DownloadError(f'Cannot resume {path}.')
+                    size = offset
+                else:
+                    response.raise_for_status()
+                    if response.status == 206:
+                        start, total = _content_range(response.headers)
+                        if start != offset:
+                            # retries would fail the same way - start over
+                            if offset:
+                                await self._fs.run(os.remove, part)
+                            raise DownloadError(f'Cannot resume {path}.')
+                    else:
+                        total = response.content_length
+                        offset = 0
+                        if hasher is not None:
+                            hasher = content_hash()
+                    flags = os.O_WRONLY | os.O_CREAT
+                    if not offset:
+                        flags |= os.O_TRUNC
+                    fd = await self._fs.run(os.open, part, flags, 0o644)
+                    try:
+                        async with FileSink(fd, offset) as sink:
+                            async for data, _ in \
+                                    response.content.iter_chunks():
+                                await self._bandwidth.acquire(len(data))
+                                await sink.write(data)
+                                if hasher is not None:
+                                    hasher.update(data)
+                                metrics.registry.inc('download_bytes_total',
+                                                     len(data))
+                    finally:
+                        os.close(fd)
+                    size = sink.position
+
+        if total is not None and size != total:
+            raise DownloadError(f'Incomplete {path}: {size}/{total} bytes.')
+        await self._fs.run(os.replace, part, path)
+        self._fs.added(path)
+        return hasher.hexdigest() if hasher is not None else None
+
+    async def _probe_size(self, url):
+        # a single byte range reveals both the size and Range support
+        await self._host_rate.acquire(URL(url).host)
         async with self._download_limiter:
-            async with self._client.get(url) as response:
+            headers = {'Range': 'bytes=0-0'}
+            async with self._media.get(url, headers=headers) as response:
                 response.raise_for_status()
-                save_dir = os.path.dirname(path)
-                if not os.path.exists(save_dir):
-                    os.makedirs(save_dir)
-                async with aiofiles.open(path, 'wb') as file:
-                    async for data, _ in response.content.iter_chunks():
-                        await file.write(data)
-
-    async def start(self):
+                if response.status != 206:
+                    return None
+                return _content_range(response.headers)[1]
+
+    async def _download_segmented(self, url, path, size, digest):
+        # segments are written in place into a preallocated file that is
+        # never resumed - a range that keeps failing fails the download
+        temp = path + config.segment_suffix
+        step = -(-size // config.segments)
+        ranges = [(start, min(start + step, size) - 1)
+                  for start in range(0, size, step)]
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        fd = await self._fs.run(os.open, temp, flags, 0o644)
+        try:
+            await self._fs.run(preallocate, fd, 0, size)
+            await self._fs.run(os.ftruncate, fd, size)
+            tasks = [asyncio.ensure_future(self._download_segment(url,
+                                                                  fd,
+                                                                  *span))
+                     for span in ranges]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                # stop the other segments before the descriptor is closed
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except BaseException:
+            await asyncio.shield(self._fs.run(_discard, fd, temp))
+            raise
+        await self._fs.run(os.close, fd)
+        await self._fs.run(os.replace, temp, path)
+        self._fs.added(path)
+        # segments arrive out of order - hash the complete file
+        if digest:
+            return (await self._fs.run(hash_file, path)).hexdigest()
+        return None
+
+    async def _download_segment(self, url, fd, first, last):
+        # a failed range is resumed where it stopped, others keep going
+        position = first
+
+        async def attempt(_):
+            nonlocal position
+            if position > last:
+                # the range was received before the error
+                return
+            await self._host_rate.acquire(URL(url).host)
+            async with self._download_limiter, \
+                    profiling.span('segment', 'network',
+                                   first=position, last=last):
+                headers = {'Range': f'bytes={position}-{last}'}
+                async with self._media.get(url, headers=headers) as response:
+                    response.raise_for_status()
+                    if response.status != 206 or \
+                            _content_range(response.headers)[0] != position:
+                        raise DownloadError(f'Range {position}-{last} '
+                                            'refused.')
+                    sink = FileSink(fd, position)
+                    try:
+                        async with sink:
+                            async for data, _ in \
+                                    response.content.iter_chunks():
+                                await self._bandwidth.acquire(len(data))
+                                await sink.write(data)
+                                metrics.registry.inc('download_bytes_total',
+                                                     len(data))
+                    finally:
+                        position = sink.position
+            if position != last + 1:
+                raise DownloadError(f'Incomplete range {first}-{last}: '
+                                    f'{position - first} bytes.')
+
+        await self._retry.call(attempt)
+
+    @property
+    def fs(self):
+        """File system access used to save downloaded data
+
+        Returns:
+            FileSystem: asynchronous file system helper
+        """
+
+        return self._fs
+
+    async def start(self, warm_up=True):
         """Start the session and initialize synchronization primitives
+
+        Args:
+            warm_up (bool, optional): open connections to API servers.
+                Defaults to True.
         """
 
-        self._client = ClientSession(headers=self._headers)
+        cookies = CookieJar()
+        self._client = self._lane(config.api_connector,
+                                  config.api_timeout,
+                                  self._api_limit,
+                                  cookies)
+        self._media = self._lane(config.media_connector,
+                                 config.media_timeout,
+                                 self._download_limit,
+                                 cookies)
         self._api_limiter = asyncio.Semaphore(self._api_limit)
         self._download_limiter = asyncio.Semaphore(self._download_limit)
+        self._api_rate = TokenBucket(config.api_rate)
+        self._bandwidth = TokenBucket(config.download_rate)
+        self._host_rate = HostBuckets(config.host_rate)
+        if warm_up:
+            await self._warm_up()
+
+    def _lane(self, options, timeout, limit, cookies):
+        # pool size follows the matching request limit unless configured
+        if config.addresses:
+            options = {'resolver': StaticResolver(config.addresses),
+                       **options}
+        connector = TCPConnector(**{'limit': limit, **options})
+        return ClientSession(headers=self._headers,
+                             connector=connector,
+                             cookie_jar=cookies,
+                             timeout=ClientTimeout(**timeout))
+
+    async def _warm_up(self):
+        # open a connection to every API server before the first request
+        timeout = ClientTimeout(total=config.warm_up_timeout)
+
+        async def connect(url):
+            try:
+                async with self._client.head(url, timeout=timeout):
+                    pass
+            except NETWORK_ERRORS:
+                pass
+
+        await asyncio.gather(*(connect(url)
+                               for url in self._ajax.balancer.urls))
 
     async def close(self):
         """Close the session and do cleanup
         """
 
-        await self._client.close()
+        for lane in (self._client, self._media):
+            if lane is not None:
+                await lane.close()
 
-    async def login(self, email, password):
+    async def login(self, email, password, store: SessionStore = None):
         """Log the user in using credentials
 
+        A session saved in the store is reused if the server still accepts
+        it. Otherwise the user logs in and the new session is saved.
+
         Args:
             email (str): account email
             password (str): account password
+            store (SessionStore, optional): saved session. Defaults to None.
         """
 
         user = User(email, password)
+        if store is not None:
+            saved = store.load(email)
+            if saved and await self._resume(user, saved):
+                print(f'User {user.nick} logged in with saved session.')
+                self._user = user
+                return
+            store.clear()
         site = Site(self._client)
         ltoken = await site.get_tag_property_by_id('zbiornik-ltoken')
         url = self._ajax.login(user.email, user.password, ltoken)
         json = await self.get(url)
         user.login(json)
         self._user = user
+        if store is not None:
+            store.save(user, self._client.cookie_jar)
+
+    async def _resume(self, user, saved):
+        # restore cookies and token, then check them with a single cheap
+        # request - the server must still recognize the same user
+        for cookie in saved.get('cookies', ()):
+            for morsel in SimpleCookie(cookie).values():
+                host = morsel['domain'].lstrip('.') or config.host
+                url = URL.build(scheme=config.scheme,
+                                host=host,
+                                port=config.port)
+                self._client.cookie_jar.update_cookies({morsel.key: morsel},
+                                                       url)
+        user.restore(saved['nick'], saved['token'])
+        self._user = user
+        try:
+            response = await self.get_profile(user.nick)
+        except (ClientResponseError, ValueError):
+            response = None
+        self._user = None
+        if not isinstance(response, dict) or response.get('error'):
+            return False
+        logged = response.get('loggedUser')
+        return isinstance(logged, dict) and logged.get('nick') == user.nick
 
     async def get_profile(self, nick):
         """Get JSON object representing a profile
@@ -254,6 +794,9 @@ class Session:
     async def get_item_info(self, itype, data, ldata):
         """Get JSON object representing a single photo
 
+        Responses are memoized - concurrent and repeated calls for the same
+        item share a single API request.
+
         Args:
             itype (str): string representation of type ('photo'/'video')
             data (str): photo's data hash obtained from JSON
@@ -263,5 +806,9 @@ class Session:
             dict: JSON object
         """
 
-        url = self._ajax.get_item_info(itype, data, ldata, self._user.token)
-        return await self.get(url)
+        async def request():
+            url = self._ajax.get_item_info(itype, data, ldata,
+                                           self._user.token)
+            return await self.get(url)
+
+        return await self._info_cache.get((itype, data, ldata), request)
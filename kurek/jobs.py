@@ -0,0 +1,200 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""Shared job queue
+
+Profiles to download are kept in a SQLite database that several hosts can
+open on shared storage - no server is needed. A host claims a profile by
+taking a lease on it and keeps renewing the lease while it works. Leases
+of crashed hosts expire and their profiles are claimed again. Finished
+profiles stay in the database marked as done or failed.
+
+The database uses rollback journal mode, because WAL does not work on
+network file systems. The file system must support POSIX locks.
+"""
+
+import os
+import time
+import uuid
+import socket
+import sqlite3
+import itertools
+import threading
+
+from kurek import config
+
+
+class JobQueue:
+    """SQLite queue of profiles with leases
+    """
+
+    _schema = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            nick TEXT PRIMARY KEY COLLATE NOCASE,
+            state TEXT NOT NULL DEFAULT 'pending',
+            owner TEXT,
+            expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            updated REAL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, expires);
+    """
+
+    def __init__(self, path, lease=None, attempts=None, owner=None):
+        """Open (or create) a queue
+
+        Args:
+            path (str): database file path
+            lease (float, optional): lease time in seconds.
+                Defaults to config.job_lease.
+            attempts (int, optional): claims of a profile before it is
+                marked as failed. Defaults to config.job_attempts.
+            owner (str, optional): name of this worker.
+                Defaults to '<host name>:<process id>:<random id>'.
+        """
+
+        save_dir = os.path.dirname(path)
+        if save_dir and not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        self._lease = lease or config.job_lease
+        self._attempts = attempts or config.job_attempts
+        # restarted containers reuse both the host name and the process id
+        self._owner = owner or (f'{socket.gethostname()}:{os.getpid()}:'
+                                f'{uuid.uuid4().hex}')
+        # claims run in an executor, the rest on the event loop thread
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path,
+                                   timeout=config.job_timeout,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=DELETE')
+        self._db.executescript(self._schema)
+
+    @property
+    def lease(self):
+        """Lease time
+
+        Returns:
+            float: seconds a claim stays valid without renewal
+        """
+
+        return self._lease
+
+    def add(self, nicks):
+        """Add profiles to the queue
+
+        Profiles already in the queue are left as they are, including
+        finished ones. Names are inserted in batches, each in a short
+        transaction, so a slow source (e.g. stdin) does not hold the queue
+        locked for other hosts.
+
+        Args:
+            nicks (Iterable): profile names
+
+        Returns:
+            int: number of added profiles
+        """
+
+        added = 0
+        nicks = iter(nicks)
+        while True:
+            batch = [(nick,) for nick in itertools.islice(nicks,
+                                                          config.job_batch)]
+            if not batch:
+                return added
+            with self._lock:
+                cursor = self._db.cursor()
+                cursor.execute('BEGIN IMMEDIATE')
+                try:
+                    cursor.executemany('INSERT OR IGNORE INTO jobs (nick) '
+                                       'VALUES (?)',
+                                       batch)
+                    added += cursor.rowcount
+                    cursor.execute('COMMIT')
+                except BaseException:
+                    cursor.execute('ROLLBACK')
+                    raise
+
+    def claim(self):
+        """Take a lease on the next pending or abandoned profile
+
+        Profiles whose leases expired more than the allowed number of times
+        are marked as failed instead.
+
+        Returns:
+            str: profile name or None if there is nothing left to do
+        """
+
+        with self._lock:
+            cursor = self._db.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                cursor.execute(
+                    "UPDATE jobs SET state = 'failed', updated = ? "
+                    "WHERE state = 'leased' AND expires < ? "
+                    "AND attempts >= ?",
+                    (now, now, self._attempts))
+                row = cursor.execute(
+                    "SELECT nick FROM jobs WHERE state = 'pending' "
+                    "OR (state = 'leased' AND expires < ?) "
+                    "ORDER BY rowid LIMIT 1",
+                    (now,)).fetchone()
+                if row is not None:
+                    cursor.execute(
+                        "UPDATE jobs SET state = 'leased', owner = ?, "
+                        "expires = ?, attempts = attempts + 1, updated = ? "
+                        "WHERE nick = ?",
+                        (self._owner, now + self._lease, now, row[0]))
+                cursor.execute('COMMIT')
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+        return row[0] if row else None
+
+    def renew(self):
+        """Extend leases of all profiles held by this worker
+        """
+
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET expires = ?, updated = ? "
+                "WHERE owner = ? AND state = 'leased'",
+                (now + self._lease, now, self._owner))
+
+    def complete(self, nick, failed=False):
+        """Record that a profile was processed
+
+        Args:
+            nick (str): profile name
+            failed (bool, optional): some items could not be downloaded.
+                Defaults to False.
+        """
+
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET state = ?, expires = NULL, updated = ? "
+                "WHERE nick = ? AND owner = ?",
+                ('failed' if failed else 'done',
+                 time.time(),
+                 nick,
+                 self._owner))
+
+    def counts(self):
+        """Count profiles in each state
+
+        Returns:
+            dict: state to number of profiles mapping
+        """
+
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT state, COUNT(*) FROM jobs GROUP BY state')
+            return dict(rows)
+
+    def close(self):
+        """Close the database
+        """
+
+        self._db.close()
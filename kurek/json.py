@@ -9,11 +9,15 @@ downloading them easier.
 """
 
 import os
-
-from yarl import URL
+import sys
+import contextlib
+from urllib.parse import urlsplit
 
 from kurek import config
-from kurek.http import Session
+from kurek import metrics
+from kurek import profiling
+from kurek import templates
+from kurek.http import Session, ResponseError
 
 
 # TODO: use proper interface (virtual class)
@@ -24,6 +28,8 @@ class Fetchable:
     or fetched using the 'fetch' method.
     """
 
+    __slots__ = ('json',)
+
     def __init__(self, json=None):
         """Create a JSON item
 
@@ -43,105 +49,126 @@ class Fetchable:
         _ = (session)
 
 
-class ItemInfo(Fetchable):
-    """Base class for info items
+@contextlib.contextmanager
+def _parsing(what):
+    """Report a malformed API response as ResponseError
 
-    ItemInfo is a JSON structured connectd to each photo and video. You can
-    obtain it via the GetItemInfo AJAX command. It has additional info about
-    the resource, such as urls. First you need to get the media list via
-    GetProfilePhotos or GetProfileVideos and then use data and lData to
-    fetch the ItemInfo.
+    Args:
+        what (str): description of the parsed response
     """
 
-    def __init__(self, itype, data, ldata):
-        """Base class for info item JSON
+    try:
+        yield
+    except (LookupError, TypeError, ValueError) as exc:
+        raise ResponseError(f'Malformed {what}: '
+                            f'{type(exc).__name__}: {exc}') from exc
 
-        Args:
-            itype (str): type of item (photo/video)
-            data (str): data hash from parent JSON item
-            ldata (_type_): lData hash from parent JSON item
-        """
 
-        super().__init__()
-        self._data = data
-        self._ldata = ldata
-        self._type = itype
+def _best_source(json):
+    """Find URL of the largest source in a JSON object
 
-    async def fetch(self, session: Session):
-        """Fetch JSON data using http session
+    Args:
+        json (dict): JSON object with 'src<size>' keys
 
-        Args:
-            session (Session): http request session
-        """
+    Returns:
+        str: source URL or None if there are no sources
+    """
 
-        json = await session.get_item_info(self._type,
-                                           self._data,
-                                           self._ldata)
-        self.json = json['item']
+    best, best_size = None, -1
+    for key in json:
+        if key.startswith('src'):
+            size = int(''.join(c for c in key if c.isdecimal()))
+            if size > best_size:
+                best, best_size = key, size
+    return json[best] if best else None
 
 
-class Item(Fetchable):
-    """Base class for JSON downloadable items
+async def save(session: Session, item, path, dedup=None):
+    """Download a resolved item unless its file already exists
 
-    An item is either a photo or a video. This class holds the basic info.
-    More fields can be obtained with using the ItemInfo object tied to objects
-    of this class.
+    Args:
+        session (Session): http request session
+        item (Item): item with a known URL
+        path (str): path to save the file to
+        dedup (kurek.dedup.DedupIndex, optional): reuse files with the same
+            media. Defaults to None.
+
+    Returns:
+        str: path of the saved file
     """
 
-    def __init__(self, item_type, json):
-        """Create a new item with additional info
+    with profiling.span('exists', 'disk'):
+        exists = await session.fs.exists(path)
+    if exists:
+        print(f'File {path} exists. Skipping.')
+        metrics.registry.inc('items_skipped_total', reason='exists')
+        return path
+    if dedup is not None:
+        method = await dedup.download(session, item, path)
+        if method is not None:
+            print(f'Reused {item.type} ({method}): {path}')
+            return path
+    else:
+        await session.download(item.url, path, item.segmented)
+    print(f'Downloaded {item.type}: {path}')
+    return path
 
-        Args:
-            item_type (str): item type string (photo/video)
-            json (dict): JSON object representing basic item summary
-        """
-
-        super().__init__(json)
-        self.type = item_type
-        data, ldata = json['data'], json['lData']
-        self.info = ItemInfo(self.type, data, ldata)
 
-    @property
-    def owner(self):
-        """Item owner's nick
-        """
+class Item(Fetchable):
+    """Base class for downloadable items
 
-        return self.json['nick']
+    An item is either a photo or a video. Only the fields needed to download
+    it are kept - the listing JSON is dropped after parsing. Items whose
+    download URL is not part of the listing resolve it by fetching item info
+    via the GetItemInfo AJAX command.
+    """
 
-    @property
-    def url(self):
-        """Download URL - override this function
-        """
+    __slots__ = ('uid', 'data', 'owner', 'title', 'description', 'url', 'ext')
+    type = None
+    segmented = False
 
-        return None
+    def __init__(self, json):
+        """Create a new item from its listing JSON
 
-    @property
-    def description(self):
-        """Description string
+        Args:
+            json (dict): JSON object representing basic item summary
         """
 
-        return self.json['description']
+        super().__init__()
+        with _parsing(f'{self.type} summary'):
+            self.uid = json['lData']
+            self.data = json['data']
+            self.owner = sys.intern(json['nick'])
+            self.title = json['title']
+            self.description = json['description']
+        self.url = None
+        self.ext = None
+
+    def _set_url(self, url):
+        self.url = url
+        self.ext = urlsplit(url).path.rpartition('/')[2][-3:] if url else None
+
+    def _resolve(self, info):
+        """Choose download URL from item info JSON - override in child
 
-    @property
-    def title(self):
-        """Title string
+        Args:
+            info (dict): item info JSON object
         """
 
-        return self.json['title']
+        _ = (info)
 
-    @property
-    def uid(self):
-        """Unique ID hash
-        """
-
-        return self.json['lData']
+    async def fetch(self, session: Session):
+        """Fetch item info to resolve the URL - no-op if it is already known
 
-    @property
-    def ext(self):
-        """File extension
+        Args:
+            session (Session): http request session
         """
 
-        return URL(self.url).parts[-1][-3:]
+        if self.url is not None:
+            return
+        json = await session.get_item_info(self.type, self.data, self.uid)
+        with _parsing(f'{self.type} info'):
+            self._resolve(json['item'])
 
     # TODO: Remove filename, savepath, download and move to separate class
     @property
@@ -149,50 +176,52 @@ class Item(Fetchable):
         """File name used for saving the file - based on configured template
         """
 
-        template = config.name_template
-        subs = {
-            '%t': self.title,
-            '%h': self.uid,
-            '%e': self.ext,
-            '%d': self.description,
-            '%o': self.owner
-        }
-        for key, value in subs.items():
-            if not value:
-                value = '_'
-            template = template.replace(key, value)
-        return template
+        return templates.name_template().render(title=self.title,
+                                                uid=self.uid,
+                                                ext=self.ext,
+                                                description=self.description,
+                                                owner=self.owner)
 
     @property
     def savepath(self):
         """Directory path where the file will be saved
         """
 
-        template = config.path_template
-        return template.replace('%d', config.root_dir) \
-                       .replace('%t', self.type) \
-                       .replace('%p', self.owner)
+        return templates.path_template().render(root=config.root_dir,
+                                                type=self.type,
+                                                profile=self.owner)
 
-    async def download(self, session: Session):
+    @property
+    def path(self):
+        """Path of the saved file
+        """
+
+        with profiling.span('render path', 'cpu'):
+            return os.path.join(self.savepath, self.filename)
+
+    async def download(self, session: Session, dedup=None):
         """Download item
 
         Args:
             session (Session): http request session
+            dedup (kurek.dedup.DedupIndex, optional): reuse files with the
+                same media. Defaults to None.
+
+        Returns:
+            str: path of the saved file
         """
 
         await self.fetch(session)
-        path = os.path.join(self.savepath, self.filename)
-        if os.path.exists(path):
-            print(f'File {path} exists. Skipping.')
-            return
-        await session.download(self.url, path)
-        print(f'Downloaded {self.type}: {path}')
+        return await save(session, self, self.path, dedup)
 
 
 class Photo(Item):
     """Represents a photo
     """
 
+    __slots__ = ()
+    type = 'photo'
+
     def __init__(self, json):
         """Create a new Photo object using JSON representation
 
@@ -200,46 +229,26 @@ class Photo(Item):
             json (str): JSON object representing a single photo
         """
 
-        super().__init__('photo', json)
-
-    @property
-    def url(self):
-        src_keys = {key: key
-                    for key in self.json if key.startswith('src')}
-        size2key = {int("".join(c for c in value if c.isdecimal())): key
-                    for key, value in src_keys.items()}
-        sorted_sizes = sorted(list(size2key.keys()), reverse=True)
-        key = size2key[sorted_sizes[0]]
-        url = self.json[key]
-        return url
+        super().__init__(json)
+        # listing JSON usually holds source URLs - info is not needed then
+        with _parsing('photo summary'):
+            self._set_url(_best_source(json))
 
-    async def fetch(self, session: Session):
-        await self.info.fetch(session)
+    def _resolve(self, info):
+        self._set_url(_best_source(info))
 
 
 class Video(Item):
     """Represents a downloadable video
     """
 
-    def __init__(self, json):
-        """Create a new Video object using JSON representation
-
-        Args:
-            json (str): JSON object representing a single video
-        """
+    __slots__ = ()
+    type = 'video'
+    segmented = True
 
-        super().__init__('video', json)
-
-    @property
-    def url(self):
-        if self.info is None:
-            return None
-        key = 'mp4480' if 'mp4480' in self.info.json else 'mp4'
-        url = self.info.json[key]
-        return url
-
-    async def fetch(self, session: Session):
-        await self.info.fetch(session)
+    def _resolve(self, info):
+        key = 'mp4480' if 'mp4480' in info else 'mp4'
+        self._set_url(info[key])
 
 
 class ProfilePhotos(Fetchable):
@@ -257,6 +266,17 @@ class ProfilePhotos(Fetchable):
         self.owner = owner
         self.items = None
 
+    def parse(self, json):
+        """Build items from collection JSON - the JSON itself is not kept
+
+        Args:
+            json (dict): GetProfilePhotos response
+        """
+
+        with _parsing('photo listing'):
+            items = [item for item in json['items'] if item['access']]
+        self.items = [Photo(item) for item in items]
+
     async def fetch(self, session: Session):
         """Fetch collection JSON info
 
@@ -264,9 +284,7 @@ class ProfilePhotos(Fetchable):
             session (Session): http request session
         """
 
-        json = await session.get_profile_photos(self.owner)
-        self.json = json['items']
-        self.items = [Photo(item) for item in json['items'] if item['access']]
+        self.parse(await session.get_profile_photos(self.owner))
 
 
 class ProfileVideos(Fetchable):
@@ -284,6 +302,17 @@ class ProfileVideos(Fetchable):
         self.owner = owner
         self.items = None
 
+    def parse(self, json):
+        """Build items from collection JSON - the JSON itself is not kept
+
+        Args:
+            json (dict): GetProfileVideos response
+        """
+
+        with _parsing('video listing'):
+            items = [item for item in json['items'] if item['access']]
+        self.items = [Video(item) for item in items]
+
     async def fetch(self, session: Session):
         """Fetch collection JSON info
 
@@ -291,9 +320,7 @@ class ProfileVideos(Fetchable):
             session (Session): http request session
         """
 
-        json = await session.get_profile_videos(self.owner)
-        self.json = json['items']
-        self.items = [Video(item) for item in json['items'] if item['access']]
+        self.parse(await session.get_profile_videos(self.owner))
 
 
 class Profile(Fetchable):
@@ -350,4 +377,5 @@ class Profile(Fetchable):
         """
 
         json = await session.get_profile(self._nick)
-        self.json = json['profile']
+        with _parsing('profile'):
+            self.json = json['profile']
@@ -0,0 +1,95 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""Rate limiting primitives
+
+Semaphores in Session only cap concurrency. Token buckets defined here cap
+the rate - requests per second or bytes per second - so that fast responses
+cannot burst above the configured throughput.
+"""
+
+import time
+import asyncio
+
+
+class TokenBucket:
+    """Token bucket rate limiter
+
+    Tokens are refilled continuously at a given rate up to the bucket
+    capacity. Taking more tokens than available puts the bucket into debt
+    and the caller sleeps until it would have been repaid, so large requests
+    (e.g. big chunks of data) are allowed but still accounted for.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """Create a new bucket
+
+        Args:
+            rate (float): tokens per second, 0 disables limiting
+            capacity (float, optional): max burst size. Defaults to rate.
+        """
+
+        self._rate = rate
+        self._capacity = capacity or rate
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+
+    @property
+    def rate(self):
+        """Refill rate
+
+        Returns:
+            float: tokens per second
+        """
+
+        return self._rate
+
+    async def acquire(self, amount=1):
+        """Take tokens from the bucket, waiting if there are not enough
+
+        Args:
+            amount (float, optional): number of tokens. Defaults to 1.
+        """
+
+        if self._rate <= 0:
+            return
+        now = time.monotonic()
+        self._tokens = min(self._capacity,
+                           self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        self._tokens -= amount
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self._rate)
+
+
+class HostBuckets:
+    """Collection of token buckets - one per host
+    """
+
+    def __init__(self, rate, capacity=None):
+        """Create per-host buckets sharing the same settings
+
+        Args:
+            rate (float): tokens per second for each host, 0 disables limiting
+            capacity (float, optional): max burst size. Defaults to rate.
+        """
+
+        self._rate = rate
+        self._capacity = capacity
+        self._buckets = {}
+
+    async def acquire(self, host, amount=1):
+        """Take tokens from the bucket of a given host
+
+        Args:
+            host (str): host name
+            amount (float, optional): number of tokens. Defaults to 1.
+        """
+
+        if self._rate <= 0:
+            return
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            bucket = TokenBucket(self._rate, self._capacity)
+            self._buckets[host] = bucket
+        await bucket.acquire(amount)
@@ -0,0 +1,312 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""Persistent manifest of downloaded items
+
+The manifest is a SQLite database that remembers every item that was saved
+to disk. Downloaders consult it before spending any API requests on an item,
+so re-runs skip known media regardless of the current path templates.
+It also stores per-profile watermarks used by the incremental sync mode
+and the media index used to deduplicate files shared between profiles.
+
+The database uses WAL mode by default. Hosts sharing a job queue keep the
+manifest on the same shared storage, where WAL does not work, so the
+rollback journal (config.manifest_journal = 'DELETE') is used with a queue.
+"""
+
+import os
+import time
+import sqlite3
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from kurek import config
+
+
+def fingerprint(items):
+    """Compute a fingerprint of a profile listing
+
+    Args:
+        items (Iterable): items of the listing
+
+    Returns:
+        str: hex digest identifying the set of item uids
+    """
+
+    digest = hashlib.sha1()
+    for uid in sorted(item.uid for item in items):
+        digest.update(uid.encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class Manifest:
+    """SQLite database of completed downloads keyed by item uid
+    """
+
+    _schema = """
+        CREATE TABLE IF NOT EXISTS items (
+            uid TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            type TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            timestamp REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS items_owner
+            ON items (owner COLLATE NOCASE, type);
+        CREATE TABLE IF NOT EXISTS watermarks (
+            owner TEXT NOT NULL COLLATE NOCASE,
+            type TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            timestamp REAL NOT NULL,
+            PRIMARY KEY (owner, type)
+        );
+        CREATE TABLE IF NOT EXISTS media (
+            source TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS media_digest ON media (digest);
+    """
+
+    def __init__(self, path, journal=None):
+        """Open (or create) a manifest database
+
+        Args:
+            path (str): database file path
+            journal (str, optional): SQLite journal mode.
+                Defaults to config.manifest_journal.
+        """
+
+        save_dir = os.path.dirname(path)
+        if save_dir and not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        self._path = path
+        # the database is used by a single thread of its own (see run)
+        self._executor = ThreadPoolExecutor(1, 'kurek-manifest')
+        self._db = sqlite3.connect(path,
+                                   timeout=config.manifest_timeout,
+                                   check_same_thread=False)
+        journal = (journal or config.manifest_journal).upper()
+        self._db.execute(f'PRAGMA journal_mode={journal}')
+        if journal == 'WAL':
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(self._schema)
+        # writes not committed yet, visible to queries
+        self._items = {}
+        self._media = {}
+        self._committed = time.monotonic()
+
+    @property
+    def path(self):
+        """Database file path
+
+        Returns:
+            str: path to the database
+        """
+
+        return self._path
+
+    async def run(self, function, *args):
+        """Run a manifest method on the database thread
+
+        Queries wait for locks held by other processes, so they never run
+        on the event loop.
+
+        Args:
+            function (Callable): manifest method
+            *args: method arguments
+
+        Returns:
+            object: method result
+        """
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    def uids(self, owner, item_type):
+        """Get uids of downloaded items of a profile
+
+        Args:
+            owner (str): profile name
+            item_type (str): item type (photo/video)
+
+        Returns:
+            set: uids of completed items
+        """
+
+        rows = self._db.execute(
+            'SELECT uid FROM items '
+            'WHERE owner = ? COLLATE NOCASE AND type = ?',
+            (owner, item_type))
+        uids = {uid for uid, in rows}
+        key = owner.casefold()
+        uids.update(row[0] for row in self._items.values()
+                    if row[2] == item_type and row[1].casefold() == key)
+        return uids
+
+    def has(self, uid):
+        """Check if an item was downloaded
+
+        Args:
+            uid (str): item uid
+
+        Returns:
+            bool: True if the item is recorded
+        """
+
+        if uid in self._items:
+            return True
+        return self._db.execute('SELECT 1 FROM items WHERE uid = ?',
+                                (uid,)).fetchone() is not None
+
+    def add(self, item, path, size):
+        """Record a completed item
+
+        Items are committed in batches (see flush).
+
+        Args:
+            item (kurek.json.Item): downloaded item
+            path (str): path the item was saved to
+            size (int): file size in bytes
+        """
+
+        self._items[item.uid] = (item.uid, item.owner, item.type, path, size,
+                                 time.time())
+        self._maybe_flush()
+
+    def watermark(self, owner, item_type):
+        """Get the listing fingerprint stored by the last completed sync
+
+        Args:
+            owner (str): profile name
+            item_type (str): item type (photo/video)
+
+        Returns:
+            str: listing fingerprint or None if profile was never synced
+        """
+
+        row = self._db.execute(
+            'SELECT fingerprint FROM watermarks WHERE owner = ? AND type = ?',
+            (owner, item_type)).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, owner, item_type, digest, count):
+        """Store the watermark of a fully downloaded listing
+
+        Pending items are committed along with it.
+
+        Args:
+            owner (str): profile name
+            item_type (str): item type (photo/video)
+            digest (str): listing fingerprint
+            count (int): number of items in the listing
+        """
+
+        self.flush([(
+            'INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?, ?)',
+            (owner, item_type, digest, count, time.time()))])
+
+    def media(self, source):
+        """Find a saved file by the source of its media
+
+        Args:
+            source (str): source URL path
+
+        Returns:
+            tuple: path and size or None if the source is unknown
+        """
+
+        if source in self._media:
+            row = self._media[source]
+            return row[2:] if row else None
+        return self._db.execute(
+            'SELECT path, size FROM media WHERE source = ?',
+            (source,)).fetchone()
+
+    def media_by_digest(self, digest):
+        """Find a saved file by its content hash
+
+        Args:
+            digest (str): hex digest of file contents
+
+        Returns:
+            tuple: path and size or None if the content is unknown
+        """
+
+        for row in self._media.values():
+            if row and row[1] == digest:
+                return row[2:]
+        return self._db.execute(
+            'SELECT path, size FROM media WHERE digest = ? LIMIT 1',
+            (digest,)).fetchone()
+
+    def add_media(self, source, digest, path, size):
+        """Record a saved file in the media index
+
+        Args:
+            source (str): source URL path
+            digest (str): hex digest of file contents
+            path (str): file path
+            size (int): file size in bytes
+        """
+
+        self._media[source] = (source, digest, path, size)
+        self._maybe_flush()
+
+    def forget_media(self, source):
+        """Remove a source whose file is gone from the media index
+
+        Args:
+            source (str): source URL path
+        """
+
+        self._media[source] = None
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if len(self._items) + len(self._media) >= config.manifest_batch or \
+                time.monotonic() - self._committed >= config.manifest_delay:
+            self.flush()
+
+    def flush(self, statements=()):
+        """Commit pending writes in a single transaction
+
+        Pending writes are kept if the commit fails and retried with the
+        next one.
+
+        Args:
+            statements (Iterable, optional): additional statements with
+                their parameters. Defaults to ().
+        """
+
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?)',
+                self._items.values())
+            self._db.executemany(
+                'INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?)',
+                (row for row in self._media.values() if row))
+            self._db.executemany(
+                'DELETE FROM media WHERE source = ?',
+                ((source,) for source, row in self._media.items()
+                 if row is None))
+            for statement, parameters in statements:
+                self._db.execute(statement, parameters)
+        self._items.clear()
+        self._media.clear()
+        self._committed = time.monotonic()
+
+    def close(self):
+        """Commit pending writes and close the database
+        """
+
+        try:
+            self._executor.submit(self.flush).result()
+        finally:
+            self._executor.shutdown()
+            self._db.close()
@@ -0,0 +1,384 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""Run metrics
+
+Counters, gauges and histograms are kept in a module-level registry and
+updated by the session, the API balancer and downloaders. An Exporter
+periodically writes the registry to a file - either a JSON snapshot or a
+Prometheus textfile collector file.
+"""
+
+import os
+import json
+import time
+import asyncio
+
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DURATION_BUCKETS = (0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0)
+
+
+class Histogram:
+    """Distribution of observed values in fixed buckets
+    """
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        """Create an empty histogram
+
+        Args:
+            bounds (tuple): upper bounds of buckets in ascending order
+        """
+
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add a value
+
+        Args:
+            value (float): observed value
+        """
+
+        for index, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Cumulative bucket counts
+
+        Returns:
+            list: (upper bound, count of values <= bound) tuples, the last
+                one for +Inf
+        """
+
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            buckets.append((bound, total))
+        buckets.append((float('inf'), self.count))
+        return buckets
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Metrics:
+    """Registry of named, labeled metrics
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._started = time.monotonic()
+        self._last = (self._started, 0)
+
+    def inc(self, name, amount=1, **labels):
+        """Increase a counter
+
+        Args:
+            name (str): counter name
+            amount (int, optional): increment. Defaults to 1.
+            **labels: label values
+        """
+
+        key = _key(name, labels)
+        self._counters[key] = self._counters.get(key, 0) + amount
+
+    def gauge(self, name, value, **labels):
+        """Set a gauge
+
+        Args:
+            name (str): gauge name
+            value (float or Callable): current value or a function returning
+                it when metrics are exported
+            **labels: label values
+        """
+
+        self._gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """Add a value to a histogram
+
+        Args:
+            name (str): histogram name
+            value (float): observed value
+            buckets (tuple, optional): bucket bounds used when the histogram
+                is created. Defaults to LATENCY_BUCKETS.
+            **labels: label values
+        """
+
+        key = _key(name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def load(self, snapshots):
+        """Replace all metrics with the sum of snapshots
+
+        Used to combine metrics of several processes. Gauges are summed as
+        well, so queue depths and requests in progress are totals.
+
+        Args:
+            snapshots (Iterable): dicts returned by 'snapshot'
+        """
+
+        self._counters.clear()
+        self._gauges.clear()
+        self._histograms.clear()
+        for snapshot in snapshots:
+            for name, entries in snapshot.get('counters', {}).items():
+                for entry in entries:
+                    self.inc(name, entry['value'], **entry['labels'])
+            for name, entries in snapshot.get('gauges', {}).items():
+                for entry in entries:
+                    key = _key(name, entry['labels'])
+                    self._gauges[key] = self._gauges.get(key, 0) + \
+                        entry['value']
+            for name, entries in snapshot.get('histograms', {}).items():
+                for entry in entries:
+                    self._add_histogram(name, entry)
+
+    def _add_histogram(self, name, entry):
+        buckets = sorted((float(bound), count)
+                         for bound, count in entry['buckets'].items())
+        key = _key(name, entry['labels'])
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            bounds = tuple(bound for bound, _ in buckets[:-1])
+            histogram = self._histograms[key] = Histogram(bounds)
+        previous = 0
+        for index, (_, count) in enumerate(buckets[:-1]):
+            histogram.counts[index] += count - previous
+            previous = count
+        histogram.sum += entry['sum']
+        histogram.count += entry['count']
+
+    def counter(self, name, **labels):
+        """Current value of a counter
+
+        Args:
+            name (str): counter name
+            **labels: label values
+
+        Returns:
+            int: counter value
+        """
+
+        return self._counters.get(_key(name, labels), 0)
+
+    def _derived(self):
+        # throughput since the start and since the previous export
+        now = time.monotonic()
+        total = sum(value for (name, _), value in self._counters.items()
+                    if name == 'download_bytes_total')
+        last_time, last_total = self._last
+        self._last = (now, total)
+        uptime = now - self._started
+        return {
+            'uptime_seconds': uptime,
+            'download_bytes_per_second': total / uptime if uptime else 0.0,
+            'recent_download_bytes_per_second':
+                (total - last_total) / (now - last_time)
+                if now > last_time else 0.0,
+        }
+
+    def _gauge_values(self):
+        for key, value in self._gauges.items():
+            yield key, value() if callable(value) else value
+
+    def snapshot(self):
+        """Current state of all metrics
+
+        Returns:
+            dict: JSON serializable metrics
+        """
+
+        def entries(items, convert):
+            grouped = {}
+            for (name, labels), value in items:
+                grouped.setdefault(name, []).append(
+                    {'labels': dict(labels), **convert(value)})
+            return grouped
+
+        return {
+            'timestamp': time.time(),
+            **self._derived(),
+            'counters': entries(self._counters.items(),
+                                lambda value: {'value': value}),
+            'gauges': entries(self._gauge_values(),
+                              lambda value: {'value': value}),
+            'histograms': entries(
+                self._histograms.items(),
+                lambda histogram: {
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'buckets': {str(bound): count
+                                for bound, count in histogram.cumulative()},
+                }),
+        }
+
+    def prometheus(self, prefix='kurek_'):
+        """Current state of all metrics in Prometheus text format
+
+        Args:
+            prefix (str, optional): metric name prefix. Defaults to 'kurek_'.
+
+        Returns:
+            str: exposition text
+        """
+
+        lines = []
+        typed = set()
+
+        def sample(kind, name, labels, value, suffix=''):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {prefix}{name} {kind}')
+            lines.append(f'{prefix}{name}{suffix}{_labels(labels)} '
+                         f'{_number(value)}')
+
+        for name, value in self._derived().items():
+            sample('gauge', name, (), value)
+        for (name, labels), value in sorted(self._counters.items()):
+            sample('counter', name, labels, value)
+        for (name, labels), value in sorted(self._gauge_values()):
+            sample('gauge', name, labels, value)
+        for (name, labels), histogram in sorted(self._histograms.items(),
+                                                key=lambda item: item[0]):
+            for bound, count in histogram.cumulative():
+                sample('histogram', name, labels + (('le', bound),), count,
+                       '_bucket')
+            sample('histogram', name, labels, histogram.sum, '_sum')
+            sample('histogram', name, labels, histogram.count, '_count')
+        return '\n'.join(lines) + '\n'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = _number(value) if isinstance(value, float) else str(value)
+        value = value.replace('\\', '\\\\').replace('"', '\\"') \
+                     .replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+registry = Metrics()
+
+
+def render(form='json', metrics=None):
+    """Render metrics in an export format
+
+    Args:
+        form (str, optional): 'json' or 'prometheus'. Defaults to 'json'.
+        metrics (Metrics, optional): rendered registry.
+            Defaults to the module registry.
+
+    Returns:
+        str: file contents
+    """
+
+    metrics = metrics or registry
+    if form == 'prometheus':
+        return metrics.prometheus()
+    return json.dumps(metrics.snapshot(), indent=1) + '\n'
+
+
+def write(path, text):
+    """Replace a file atomically so readers never see a partial export
+
+    Args:
+        path (str): output file
+        text (str): file contents
+    """
+
+    temp = f'{path}.{os.getpid()}.tmp'
+    with open(temp, 'w', encoding='utf-8') as file:
+        file.write(text)
+    os.replace(temp, path)
+
+
+class Exporter:
+    """Periodic writer of the metrics registry to a file
+    """
+
+    def __init__(self, path, form='json', interval=10, metrics=None):
+        """Create a new exporter
+
+        Args:
+            path (str): output file
+            form (str, optional): 'json' or 'prometheus'. Defaults to 'json'.
+            interval (float, optional): seconds between exports.
+                Defaults to 10.
+            metrics (Metrics, optional): exported registry.
+                Defaults to the module registry.
+        """
+
+        self._path = path
+        self._form = form
+        self._interval = interval
+        self._metrics = metrics or registry
+        self._task = None
+
+    def render(self):
+        """Render the registry in the configured format
+
+        Returns:
+            str: file contents
+        """
+
+        return render(self._form, self._metrics)
+
+    async def write(self):
+        """Write current metrics to the file
+        """
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, write, self._path, self.render())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self.write()
+            except OSError as exc:
+                print(f'Failed to write metrics: {exc}')
+
+    def start(self):
+        """Start writing metrics periodically
+        """
+
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop periodic writes and write the final state
+        """
+
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.write()
@@ -0,0 +1,126 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""Download plans
+
+A plan is a JSON Lines file with one resolved item per line - its download
+URL, target path and metadata. Planning needs API requests and a login,
+executing a plan needs neither, so the transfer can be replayed later or
+split between hosts.
+"""
+
+import sys
+import json as jsonlib
+
+from kurek import json
+from kurek.http import Session
+
+
+class PlanItem:
+    """Resolved item read from a plan
+    """
+
+    __slots__ = ('uid', 'owner', 'type', 'url', 'path', 'segmented')
+
+    def __init__(self, record):
+        """Create an item from a plan record
+
+        Args:
+            record (dict): decoded plan line
+        """
+
+        self.uid = record['uid']
+        self.owner = sys.intern(record['owner'])
+        self.type = record['type']
+        self.url = record['url']
+        self.path = record['path']
+        self.segmented = record.get('segmented', False)
+
+    async def download(self, session: Session, dedup=None):
+        """Download item
+
+        Args:
+            session (Session): http request session
+            dedup (kurek.dedup.DedupIndex, optional): reuse files with the
+                same media. Defaults to None.
+
+        Returns:
+            str: path of the saved file
+        """
+
+        return await json.save(session, self, self.path, dedup)
+
+
+def record(item):
+    """Build a plan record of a resolved item
+
+    Args:
+        item (kurek.json.Item): item with a known URL
+
+    Returns:
+        dict: JSON serializable record
+    """
+
+    return {
+        'uid': item.uid,
+        'owner': item.owner,
+        'type': item.type,
+        'url': item.url,
+        'path': item.path,
+        'segmented': item.segmented,
+        'title': item.title,
+        'description': item.description,
+        'ext': item.ext,
+    }
+
+
+class PlanWriter:
+    """Writer of plan files
+    """
+
+    def __init__(self, path):
+        """Open a plan file for writing
+
+        Args:
+            path (str): plan file path
+        """
+
+        self._file = open(path, 'w', encoding='utf-8')
+        self.count = 0
+
+    def write(self, item):
+        """Append a resolved item to the plan
+
+        Args:
+            item (kurek.json.Item): item with a known URL
+        """
+
+        self._file.write(jsonlib.dumps(record(item), ensure_ascii=False))
+        self._file.write('\n')
+        self.count += 1
+
+    def close(self):
+        """Flush and close the file
+        """
+
+        self._file.close()
+
+
+def read_plan(path):
+    """Stream items of a plan file
+
+    Args:
+        path (str): plan file path ('-' for standard input)
+
+    Yields:
+        PlanItem: planned item
+    """
+
+    file = sys.stdin if path == '-' else open(path, 'r', encoding='utf-8')
+    try:
+        for line in file:
+            if line.strip():
+                yield PlanItem(jsonlib.loads(line))
+    finally:
+        if file is not sys.stdin:
+            file.close()
@@ -0,0 +1,171 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""Profiling hooks
+
+Hot paths are wrapped in named spans. Spans cost nothing until tracing is
+enabled - then every span is recorded as a Chrome trace event on a lane of
+the asyncio task that ran it, so the trace shows where each task waits:
+the network, rate limiters or the disk. 'run' combines tracing with
+cProfile, which shows where the event loop spends CPU time.
+
+Traces can be opened in chrome://tracing or https://ui.perfetto.dev.
+"""
+
+import os
+import json
+import time
+import asyncio
+import weakref
+import itertools
+
+
+_events = None
+_lanes = weakref.WeakKeyDictionary()
+_numbers = itertools.count(1)
+
+
+def _lane():
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is None:
+        return 0
+    lane = _lanes.get(task)
+    if lane is None:
+        lane = _lanes[task] = next(_numbers)
+        if _events is not None:
+            _events.append({'name': 'thread_name',
+                            'ph': 'M',
+                            'pid': os.getpid(),
+                            'tid': lane,
+                            'args': {'name': task.get_name()}})
+    return lane
+
+
+class _Span:
+    __slots__ = ('_name', '_category', '_args', '_lane', '_start')
+
+    def __init__(self, name, category, args):
+        self._name = name
+        self._category = category
+        self._args = args
+        self._lane = 0
+        self._start = 0.0
+
+    def __enter__(self):
+        self._lane = _lane()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        end = time.perf_counter()
+        if _events is not None:
+            _events.append({'name': self._name,
+                            'cat': self._category,
+                            'ph': 'X',
+                            'ts': self._start * 1e6,
+                            'dur': (end - self._start) * 1e6,
+                            'pid': os.getpid(),
+                            'tid': self._lane,
+                            'args': self._args})
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *args):
+        self.__exit__(*args)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        pass
+
+
+_null = _NullSpan()
+
+
+def span(name, category='', **args):
+    """Time a block of code
+
+    Args:
+        name (str): span name
+        category (str, optional): span category. Defaults to ''.
+        **args: values shown with the span
+
+    Returns:
+        context manager: records the span if tracing is enabled, usable
+            with both 'with' and 'async with'
+    """
+
+    if _events is None:
+        return _null
+    return _Span(name, category, args)
+
+
+def start_trace():
+    """Start recording spans
+    """
+
+    global _events
+    _events = []
+    _lanes.clear()
+
+
+def stop_trace():
+    """Stop recording spans
+
+    Returns:
+        dict: Chrome trace with recorded spans
+    """
+
+    global _events
+    events, _events = _events or [], None
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def run(coroutine, prefix):
+    """Run a coroutine with cProfile and span tracing enabled
+
+    Writes '<prefix>.pstats' with cProfile statistics and
+    '<prefix>.trace.json' with the Chrome trace. Threads of the executor
+    (file writes) are not seen by cProfile - their time shows up in the
+    disk spans of the trace.
+
+    Args:
+        coroutine (Coroutine): main coroutine
+        prefix (str): output file path without extension
+
+    Returns:
+        object: coroutine result
+    """
+
+    import cProfile
+
+    directory = os.path.dirname(prefix)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    profiler = cProfile.Profile()
+    start_trace()
+    profiler.enable()
+    try:
+        return asyncio.run(coroutine)
+    finally:
+        profiler.disable()
+        trace = stop_trace()
+        profiler.dump_stats(prefix + '.pstats')
+        with open(prefix + '.trace.json', 'w', encoding='utf-8') as file:
+            json.dump(trace, file)
+        print(f'Profile saved to {prefix}.pstats and {prefix}.trace.json')
@@ -0,0 +1,188 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""Retry and circuit breaker policies
+
+Transient failures - dropped connections, timeouts and some HTTP statuses -
+are retried with exponential backoff and jitter. A circuit breaker stops
+traffic to a server that keeps failing for a cooldown period.
+"""
+
+import re
+import time
+import random
+import asyncio
+import itertools
+
+from aiohttp import ClientResponseError
+
+
+_query = re.compile(r'''(\w+://[^\s'"?#]*)[?#][^\s'"]*''')
+
+
+def describe(exc):
+    """Describe an error for the log
+
+    Query strings are removed from URLs in the message - API requests carry
+    the session token and the login request carries the password.
+
+    Args:
+        exc (Exception): error
+
+    Returns:
+        str: error description
+    """
+
+    return _query.sub(r'\1', str(exc)) or type(exc).__name__
+
+
+class RetryPolicy:
+    """Decide whether and when to retry a failed request
+    """
+
+    def __init__(self,
+                 attempts,
+                 base_delay,
+                 max_delay,
+                 statuses=(),
+                 exceptions=()):
+        """Create a new retry policy
+
+        Args:
+            attempts (int): max number of attempts (1 - no retries)
+            base_delay (float): delay before the first retry in seconds
+            max_delay (float): upper bound of a single delay in seconds
+            statuses (Iterable, optional): retryable HTTP statuses.
+                Defaults to ().
+            exceptions (tuple, optional): retryable exception types.
+                Defaults to ().
+        """
+
+        self._attempts = max(attempts, 1)
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._statuses = frozenset(statuses)
+        self._exceptions = tuple(exceptions)
+
+    def retryable(self, exc):
+        """Classify an exception
+
+        Args:
+            exc (Exception): exception raised by a request
+
+        Returns:
+            bool: the request may succeed if repeated
+        """
+
+        if isinstance(exc, ClientResponseError):
+            return exc.status in self._statuses
+        return isinstance(exc, self._exceptions)
+
+    def delay(self, attempt, exc=None):
+        """Compute delay before the next attempt ("full jitter" backoff)
+
+        Args:
+            attempt (int): number of the failed attempt (0-based)
+            exc (Exception, optional): exception raised. Defaults to None.
+
+        Returns:
+            float: delay in seconds
+        """
+
+        delay = random.uniform(0, min(self._max_delay,
+                                      self._base_delay * 2 ** attempt))
+        headers = getattr(exc, 'headers', None) or {}
+        retry_after = headers.get('Retry-After', '')
+        if retry_after.isdecimal():
+            delay = max(delay, min(float(retry_after), self._max_delay))
+        return delay
+
+    async def call(self, factory):
+        """Run a request until it succeeds or retries are exhausted
+
+        Args:
+            factory (Callable): takes the attempt number and returns
+                a coroutine making the request
+
+        Returns:
+            object: result of the successful attempt
+        """
+
+        for attempt in itertools.count():
+            try:
+                return await factory(attempt)
+            except Exception as exc:
+                if attempt + 1 >= self._attempts or not self.retryable(exc):
+                    raise
+                delay = self.delay(attempt, exc)
+                print(f'Request failed ({describe(exc)}). '
+                      f'Retrying in {delay:.1f}s.')
+            await asyncio.sleep(delay)
+
+
+class CircuitBreaker:
+    """Stop sending requests to a failing server for a while
+
+    The breaker opens after a number of consecutive failures. Once the
+    cooldown passes it lets requests through again; a single success closes
+    it and another failure opens it for another cooldown.
+    """
+
+    def __init__(self, failures, cooldown):
+        """Create a closed breaker
+
+        Args:
+            failures (int): consecutive failures that open the breaker
+            cooldown (float): time in seconds the breaker stays open
+        """
+
+        self._threshold = failures
+        self._cooldown = cooldown
+        self._failures = 0
+        self._opened = None
+
+    @property
+    def closed(self):
+        """Breaker lets requests through without restrictions
+
+        Returns:
+            bool: no recent run of failures
+        """
+
+        return self._opened is None
+
+    @property
+    def retry_at(self):
+        """Time at which the open breaker lets a probe request through
+
+        Returns:
+            float: time.monotonic() timestamp (0 if closed)
+        """
+
+        if self._opened is None:
+            return 0.0
+        return self._opened + self._cooldown
+
+    def allow(self):
+        """Check if a request may be sent
+
+        Returns:
+            bool: breaker is closed or its cooldown has passed
+        """
+
+        return self._opened is None or time.monotonic() >= self.retry_at
+
+    def success(self):
+        """Record a successful request
+        """
+
+        self._failures = 0
+        self._opened = None
+
+    def failure(self):
+        """Record a failed request
+        """
+
+        self._failures += 1
+        if self._failures >= self._threshold:
+            self._opened = time.monotonic()
@@ -0,0 +1,213 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""Multi-process execution
+
+Profiles are split between worker processes by a stable hash of the
+profile name, so a profile always lands in the same shard. Every worker
+runs its own event loop and Session. The coordinator splits the input
+into shard files, gives every worker an equal share of the global limits
+and merges worker metrics and plans.
+"""
+
+import os
+import copy
+import json
+import time
+import zlib
+import shutil
+import tempfile
+import multiprocessing
+
+from kurek import metrics
+
+
+def shard_of(nick, count):
+    """Choose the shard of a profile
+
+    Args:
+        nick (str): profile name
+        count (int): number of shards
+
+    Returns:
+        int: shard index
+    """
+
+    return zlib.crc32(nick.casefold().encode('utf-8')) % count
+
+
+def split_nicks(nicks, count, directory):
+    """Write profile names to shard files
+
+    Args:
+        nicks (Iterable): profile names
+        count (int): number of shards
+        directory (str): directory for the shard files
+
+    Returns:
+        list: shard file paths
+    """
+
+    paths = [os.path.join(directory, f'nicks.{index}')
+             for index in range(count)]
+    files = [open(path, 'w', encoding='utf-8') for path in paths]
+    try:
+        for nick in nicks:
+            files[shard_of(nick, count)].write(nick + '\n')
+    finally:
+        for file in files:
+            file.close()
+    return paths
+
+
+def split_plan(lines, count, directory):
+    """Write plan lines to shard files by the owner of their items
+
+    Args:
+        lines (Iterable): plan lines
+        count (int): number of shards
+        directory (str): directory for the shard files
+
+    Returns:
+        list: shard file paths
+    """
+
+    paths = [os.path.join(directory, f'plan.{index}')
+             for index in range(count)]
+    files = [open(path, 'w', encoding='utf-8') for path in paths]
+    try:
+        for line in lines:
+            if line.strip():
+                owner = json.loads(line)['owner']
+                files[shard_of(owner, count)].write(line.rstrip('\n') + '\n')
+    finally:
+        for file in files:
+            file.close()
+    return paths
+
+
+def _share(value, count):
+    # limits are divided evenly, at least one for each worker
+    if isinstance(value, int):
+        return max(value // count, 1)
+    return value / count
+
+
+def worker_args(args, index, count, directory, shard):
+    """Arguments of a worker process
+
+    Args:
+        args (argparse.Namespace): coordinator arguments
+        index (int): worker index
+        count (int): number of workers
+        directory (str): directory for worker files
+        shard (str): shard file with profile names or plan lines, None
+            if workers claim profiles from a job queue
+
+    Returns:
+        argparse.Namespace: worker arguments
+    """
+
+    worker = copy.copy(args)
+    worker.workers = 1
+    worker.profiles = []
+    if args.from_plan:
+        worker.from_plan = shard
+    elif shard is not None:
+        worker.file = shard
+    for name in ('api_limit', 'download_limit', 'profile_limit'):
+        setattr(worker, name, _share(getattr(args, name), count))
+    for name in ('api_rate', 'host_rate', 'bandwidth'):
+        # a rate of 0 means no limit
+        if getattr(args, name):
+            setattr(worker, name, _share(getattr(args, name), count))
+    if args.plan_path:
+        worker.plan_path = os.path.join(directory, f'plan.out.{index}')
+    if args.metrics:
+        worker.metrics = os.path.join(directory, f'metrics.{index}.json')
+        worker.metrics_format = 'json'
+    if args.profile_path:
+        worker.profile_path = f'{args.profile_path}.{index}'
+    return worker
+
+
+def _merge_metrics(args, directory, count, registry):
+    snapshots = []
+    for index in range(count):
+        path = os.path.join(directory, f'metrics.{index}.json')
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                snapshots.append(json.load(file))
+        except (OSError, ValueError):
+            continue
+    registry.load(snapshots)
+    metrics.write(args.metrics, metrics.render(args.metrics_format, registry))
+
+
+def _merge_plans(args, directory, count):
+    with open(args.plan_path, 'w', encoding='utf-8') as plan:
+        for index in range(count):
+            path = os.path.join(directory, f'plan.out.{index}')
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as part:
+                    shutil.copyfileobj(part, plan)
+
+
+def _work(args):
+    # the entry module cannot be re-imported by spawned processes when the
+    # program runs as 'python -m kurek', so it is imported by name here
+    from kurek.__main__ import work
+    work(args)
+
+
+def run(args, inputs):
+    """Run workers and wait for them to finish
+
+    Args:
+        args (argparse.Namespace): parsed arguments with 'workers' > 1
+        inputs (Iterable): profile names or plan lines (with '--from-plan'),
+            not used with a job queue
+
+    Returns:
+        int: number of workers that failed
+    """
+
+    count = args.workers
+    context = multiprocessing.get_context('spawn')
+    registry = metrics.Metrics()
+    # worker metrics are merged into a single file by the coordinator
+    metrics_dir = os.path.dirname(args.metrics) if args.metrics else None
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix='kurek-') as directory:
+        if args.queue:
+            shards = [None] * count
+        else:
+            split = split_plan if args.from_plan else split_nicks
+            shards = split(inputs, count, directory)
+        processes = [context.Process(target=_work,
+                                     args=(worker_args(args,
+                                                       index,
+                                                       count,
+                                                       directory,
+                                                       shard),),
+                                     name=f'kurek-{index}')
+                     for index, shard in enumerate(shards)]
+        for process in processes:
+            process.start()
+        try:
+            while any(process.is_alive() for process in processes):
+                deadline = time.monotonic() + (args.metrics_interval
+                                               if args.metrics else 3600)
+                for process in processes:
+                    process.join(max(deadline - time.monotonic(), 0))
+                if args.metrics:
+                    _merge_metrics(args, directory, count, registry)
+        finally:
+            for process in processes:
+                process.join()
+        if args.metrics:
+            _merge_metrics(args, directory, count, registry)
+        if args.plan_path:
+            _merge_plans(args, directory, count)
+    return sum(1 for process in processes if process.exitcode)
@@ -0,0 +1,141 @@
+# Copyright (C) Bartosz Bartyzel 2022
+# Distributed under the MIT License.
+# License terms are at https://opensource.org/licenses/MIT and in LICENSE.md
+"""Path and file name templates
+
+Templates use '%<letter>' tokens (and '%%' for a literal percent sign).
+They are validated and compiled into a format string once, so rendering
+a path for an item is a single str.format_map call.
+"""
+
+import os
+import functools
+
+from kurek import config
+
+
+NAME_TOKENS = {
+    't': 'title',
+    'h': 'uid',
+    'e': 'ext',
+    'd': 'description',
+    'o': 'owner',
+}
+PATH_TOKENS = {
+    'd': 'root',
+    'p': 'profile',
+    't': 'type',
+}
+
+
+def sanitize(value):
+    """Default sanitizer of template values
+
+    Empty values are replaced with '_' and path separators are removed so
+    that a value cannot change the directory a file is saved to.
+
+    Args:
+        value (str): raw value
+
+    Returns:
+        str: value safe to use in a file name
+    """
+
+    if not value:
+        return '_'
+    for separator in (os.sep, os.altsep, '\0'):
+        if separator:
+            value = value.replace(separator, '_')
+    return value
+
+
+class Template:
+    """Compiled template string
+    """
+
+    def __init__(self, template, tokens, sanitizer=None):
+        """Compile a template
+
+        Args:
+            template (str): template string with '%<letter>' tokens
+            tokens (dict): token letter to field name mapping
+            sanitizer (Callable, optional): applied to every value.
+                Defaults to None.
+
+        Raises:
+            ValueError: template contains an unknown token
+        """
+
+        parts = []
+        fields = []
+        chars = iter(template)
+        for char in chars:
+            if char != '%':
+                parts.append(char.replace('{', '{{').replace('}', '}}'))
+                continue
+            token = next(chars, '')
+            if token == '%':
+                parts.append('%')
+            elif token in tokens:
+                parts.append(f'{{{tokens[token]}}}')
+                fields.append(tokens[token])
+            else:
+                raise ValueError(f"unknown token '%{token}' in template "
+                                 f"'{template}' (allowed: "
+                                 f"{', '.join('%' + t for t in tokens)})")
+        self._format = ''.join(parts)
+        self._fields = tuple(set(fields))
+        self._sanitizer = sanitizer
+
+    @property
+    def fields(self):
+        """Names of fields used by the template
+
+        Returns:
+            tuple: field names
+        """
+
+        return self._fields
+
+    def render(self, **values):
+        """Substitute tokens with values
+
+        Args:
+            **values: field values - only those used by the template are
+                required
+
+        Returns:
+            str: rendered template
+        """
+
+        if self._sanitizer is not None:
+            values = {field: self._sanitizer(values[field])
+                      for field in self._fields}
+        return self._format.format_map(values)
+
+
+@functools.lru_cache(maxsize=None)
+def _compile(template, kind, sanitizer):
+    tokens = NAME_TOKENS if kind == 'name' else PATH_TOKENS
+    return Template(template, tokens, sanitizer)
+
+
+def name_template():
+    """Compiled file name template from config
+
+    Returns:
+        Template: compiled config.name_template
+    """
+
+    return _compile(config.name_template, 'name',
+                    config.sanitizer or sanitize)
+
+
+def path_template():
+    """Compiled save path template from config
+
+    Returns:
+        Template: compiled config.path_template
+    """
+
+    return _compile(config.path_template, 'path', None)